@@ -0,0 +1,110 @@
+from pycparser import c_ast
+
+import cfg
+import ext_pycparser
+
+# Functions smaller than this are budgeted as if they were this size
+# so small callers can still take in some macros.
+SMALL_FUNCTION = 100
+
+class CountNodes(ext_pycparser.NodeVisitor):
+	def __init__(self):
+		self.result = 0
+
+	def generic_visit(self, n):
+		self.result += 1
+		ext_pycparser.NodeVisitor.generic_visit(self, n)
+
+def size_of(n):
+	"""
+	AST -> int
+
+	Number of the nodes. The text after the macros are expanded grows
+	with it.
+	"""
+	return ext_pycparser.Result(CountNodes()).visit(n)
+
+class Budget:
+	"""
+	Cost model of the macro expansions.
+
+	A macro call is expanded into the whole body of the macro including
+	the macro calls in it, so the size grows multiplicatively with the
+	depth of the call chain (f calls g twice, g calls h twice, ...).
+	The functions are rewritten from the callees (see order()) so the
+	expanded size and the nesting depth of the callee are known when a
+	call is to be admitted. The calls not admitted stay real calls.
+
+	Limits:
+	- cfg.t.max_depth: nesting depth of the macros
+	- cfg.t.function_growth: size of a function after expansion relative to the original
+	- cfg.t.unit_growth: size of the TU after expansion relative to the original
+	"""
+	def __init__(self, all_funcs, macroizables):
+		self.all_funcs = all_funcs # name -> (i, ast)
+		self.macroizables = macroizables
+		self.base = {} # name -> size of the definition
+		for name, (_, func) in all_funcs.items():
+			self.base[name] = size_of(func)
+		self.size = {} # name -> size after expansion
+		self.depth = {} # name -> nesting depth of the macro
+		self.finished = set()
+		self.unit_left = (cfg.t.unit_growth - 1) * sum(self.base.values())
+
+	def order(self):
+		"""
+		Names of the functions. The macroizable callees come before the callers
+		unless they call each other.
+		"""
+		result = []
+		marked = set()
+		def visit(name):
+			# Explicit stack. Call chains can be long.
+			marked.add(name)
+			stack = [(name, iter(self.callees(name)))]
+			while stack:
+				caller, callees = stack[-1]
+				callee = next(callees, None)
+				if callee is None:
+					stack.pop()
+					result.append(caller)
+				elif callee not in marked:
+					marked.add(callee)
+					stack.append((callee, iter(self.callees(callee))))
+		for _, name in sorted([(i, name) for name, (i, _) in self.all_funcs.items()]):
+			if name not in marked:
+				visit(name)
+		return result
+
+	def callees(self, name):
+		_, func = self.all_funcs[name]
+		calls = ext_pycparser.Result(ext_pycparser.AllFuncCalls()).visit(func)
+		names = [c.name.name for c in calls if isinstance(c.name, c_ast.ID)]
+		return [n for n in names if n in self.macroizables and n != name]
+
+	def begin(self, name):
+		self.size[name] = self.base[name]
+		self.depth[name] = 1
+
+	def admit(self, caller, callee):
+		"""
+		True if the call in caller can be expanded.
+		"""
+		if callee not in self.finished: # They call each other
+			return False
+		if self.depth[callee] > cfg.t.max_depth:
+			return False
+		grown = self.size[caller] + self.size[callee]
+		if grown > cfg.t.function_growth * max(self.base[caller], SMALL_FUNCTION):
+			return False
+		# The bodies of the macroizable functions are only expanded where they are called.
+		charge = 0 if caller in self.macroizables else self.size[callee]
+		if charge > self.unit_left:
+			return False
+		self.unit_left -= charge
+		self.size[caller] = grown
+		self.depth[caller] = max(self.depth[caller], self.depth[callee] + 1)
+		return True
+
+	def finish(self, name):
+		self.finished.add(name)
@@ -0,0 +1,170 @@
+from pycparser import c_ast, c_parser
+
+import cPickle as pickle
+import cfg
+import ext_pycparser
+import hashlib
+import os
+import pycparser
+import re
+import utils
+import zlib
+
+def tool_stamp():
+	"""
+	Hash of the sources of this program.
+	The cached ASTs are invalidated when the program is changed.
+	"""
+	h = hashlib.sha1()
+	for fn in utils.tool_files():
+		with open(fn, "rb") as fp:
+			h.update(fp.read())
+	return h.hexdigest()
+
+def segments(txt, main):
+	"""
+	Text -> [(header, text)]
+
+	The runs of the lines of the main file and of the code it includes,
+	told by the line markers. header is None for the main file and
+	the file the run enters first (e.g. #include <stdio.h>) otherwise.
+	Every run begins with its line marker so the coords are kept.
+	"""
+	result = []
+	lines = []
+	header = None
+	for line in txt.splitlines():
+		m = utils.LINEMARKER.match(line) if line.startswith("#") else None
+		if m:
+			fn = m.group(1).replace('\\\\', '\\')
+			if (fn == main) != (header is None):
+				if lines:
+					result.append((header, '\n'.join(lines) + '\n'))
+				lines = []
+				header = None if fn == main else fn
+		lines.append(line)
+	if lines:
+		result.append((header, '\n'.join(lines) + '\n'))
+	return result
+
+class ASTCache:
+	"""
+	Text -> AST
+
+	Cache of parsed ASTs keyed by the hash of the text. Parsing is the
+	largest fixed cost and the same text is parsed again and again
+	across runs (e.g. with different -O masks or in benchmark loops).
+
+	Most of the text of a file is the code of the headers and the files
+	include the same headers. The code of each header is parsed and cached
+	on its own (see parse), so the files share it.
+
+	The ASTs are kept serialized (pickled and compressed) on disk
+	(cfg.t.cache_dir) and in memory so every lookup returns a fresh AST
+	that the caller can modify.
+	"""
+	def __init__(self):
+		self.memo = {} # key -> serialized AST
+		self.stamp = None
+
+	def key(self, kind, txt):
+		if self.stamp is None:
+			self.stamp = tool_stamp()
+		h = hashlib.sha1()
+		h.update("%s\0%s\0%s\0" % (kind, pycparser.__version__, self.stamp))
+		h.update("%s\0" % ' '.join(sorted(ext_pycparser.TYPEDEFS))) # Changes the parse
+		h.update("%s\0" % ' '.join(sorted(ext_pycparser.QUALIFIERS)))
+		h.update(txt)
+		return h.hexdigest()
+
+	def path(self, key):
+		return os.path.join(cfg.t.cache_dir, "%s.ast" % key)
+
+	def load(self, key):
+		if key in self.memo:
+			return self.memo[key]
+		if not cfg.t.cache_dir:
+			return None
+		if os.path.exists(self.path(key)):
+			with open(self.path(key), "rb") as fp:
+				self.memo[key] = fp.read()
+			return self.memo[key]
+		return None
+
+	def store(self, key, ast):
+		if not cfg.t.cache_dir:
+			return
+		try:
+			# Flattened not to recurse over the depth of the AST.
+			# Fastest level. The pickles of ASTs are highly redundant anyway.
+			data = zlib.compress(pickle.dumps(ext_pycparser.flatten(ast), pickle.HIGHEST_PROTOCOL), 1)
+		except RuntimeError: # Too deep in the nodes of our own (e.g. Aside). Don't cache it.
+			return
+		self.memo[key] = data
+		try:
+			os.makedirs(cfg.t.cache_dir)
+		except OSError: # Already exists
+			pass
+		utils.write_file(self.path(key), data)
+
+	def cached(self, key, parse):
+		"""
+		parse :: () -> AST
+		Called and cached if the key misses.
+		"""
+		data = self.load(key)
+		if data is not None:
+			try:
+				return ext_pycparser.unflatten(pickle.loads(zlib.decompress(data)))
+			except (RuntimeError, zlib.error, pickle.UnpicklingError): # Broken or too deep. Parse again.
+				pass
+		ast = parse()
+		self.store(key, ast)
+		return ast
+
+	def header_ast(self, header, txt, typedefs):
+		"""
+		The code included from the header. The preprocessed text tells
+		the contents and the macros at the inclusion. The typedef names
+		declared before and used in the text change the parse too.
+		"""
+		used = typedefs & set(re.findall(r'[A-Za-z_$][\w$]*', txt))
+		key = self.key("header", "%s\0%s\0%s" % (header, ' '.join(sorted(used)), txt))
+		return self.cached(key, lambda: ext_pycparser.ast_of(txt, used))
+
+	def parse(self, txt):
+		"""
+		The runs of the headers are parsed (or loaded) one by one and
+		the typedef names declared so far are given to the next runs.
+		A declaration split by an #include can't be parsed in pieces.
+		The whole text is parsed then.
+		"""
+		main = utils.included_files(txt)[:1]
+		if not cfg.t.cache_dir or not main:
+			return ext_pycparser.ast_of(txt)
+		ext = []
+		typedefs = set()
+		try:
+			for header, run in segments(txt, main[0]):
+				if header is None:
+					ast = ext_pycparser.ast_of(run, typedefs)
+				else:
+					ast = self.header_ast(header, run, typedefs)
+				for n in ast.ext:
+					if isinstance(n, c_ast.Typedef):
+						typedefs.add(n.name)
+					elif isinstance(n, c_ast.Decl) and n.name: # Hides the typedef
+						typedefs.discard(n.name)
+				ext.extend(ast.ext)
+		except c_parser.ParseError:
+			return ext_pycparser.ast_of(txt)
+		return c_ast.FileAST(ext)
+
+	def ast_of(self, txt, prepare=lambda ast: ast, kind="parse"):
+		"""
+		prepare :: AST -> AST
+		Applied to the parsed AST before caching.
+		"""
+		return self.cached(self.key(kind, txt), lambda: prepare(self.parse(txt)))
+
+t = ASTCache()
@@ -7,5 +7,16 @@ class Env:
 		self.extra_options = []
 		self.inline_mask = 7
 		self.fake_include = None
+		self.fake_typedefs = False
+		self.name_prefix = "_moi"
+		self.name_seed = 0
+		self.cache_dir = None
+		self.profile_data = None
+		self.profile_threshold = 100
+		self.max_depth = 8
+		self.function_growth = 10.0
+		self.unit_growth = 10.0
+		self.dialect = "ansi"
+		self.unroll_recursion = 0
 
 t = Env()
@@ -23,49 +23,49 @@ class Brace(ext_pycparser.NodeVisitor):
 		if not isinstance(n.iffalse, c_ast.Compound):
 			comp = mk([n.iffalse])
 			n.iffalse = comp
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_Case(self, n):
 		# print(type(n))
 		if not isinstance(n.stmts, c_ast.Compound):
 			comp = mk(n.stmts)
 			n.stmts = [comp]
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_Default(self, n):
 		# print(type(n))
 		if not isinstance(n.stmts, c_ast.Compound):
 			comp = mk(n.stmts)
 			n.stmts = [comp]
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_Switch(self, n):
 		# print(type(n))
 		if not isinstance(n.stmt, c_ast.Compound):
 			comp = mk([n.stmt])
 			n.stmt = comp
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_For(self, n):
 		# print(type(n))
 		if not isinstance(n.stmt, c_ast.Compound):
 			comp = mk([n.stmt])
 			n.stmt = comp
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_While(self, n):
 		# print(type(n))
 		if not isinstance(n.stmt, c_ast.Compound):
 			comp = mk([n.stmt])
 			n.stmt = comp
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 	def visit_DoWhile(self, n):
 		# print(type(n))
 		if not isinstance(n.stmt, c_ast.Compound):
 			comp = mk([n.stmt])
 			n.stmt = comp
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 class NodeVisitor(ext_pycparser.NodeVisitor):
 
@@ -177,7 +177,7 @@ class PrintCompound(NodeVisitor):
 	"""
 	def visit_Compound(self, n):
 		print("compound")
-		c_ast.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
 
 t1 = r"""
 void f(int a, int b)
@@ -15,7 +15,7 @@ def cpp(filename):
 	"""
 	# TODO Use pkg_resources or something that fits more.
 	p = os.path.join(os.path.dirname(__file__), 'fake_libc_include')
-	cpp_args = ['-U__GNUC__', r'-I%s' % p]
+	cpp_args = [r'-I%s' % p]
 
 	cpp_args.extend([r'%s' % utils.to_option(option) for option in cfg.t.extra_options])
 
@@ -24,113 +24,59 @@ def cpp(filename):
 	output = utils.preprocess_file(filename, cpp_path='mcpp', cpp_args=cpp_args)
 	return '\n'.join([x for x in output.split('\n') if not x.startswith("_Pragma(")])
 
-def analyzeInclude(filename, txt, orig_txt):      
+def analyzeInclude(filename, txt, orig_txt):
 	"""
-	Text -> (include_directives, Text)
+	Text -> include_directives
 	"""
-        current_result = None
-        include_statements = []
-        include_code = []
-        lineno = 0
-        orig_txt_lines = orig_txt.splitlines()
-    
-        for line in txt.splitlines():
-            if line.startswith("#line"):
-                xs = line.split()
-                fn = xs[2].strip('"')
-                fn = fn.replace('\\\\', '\\')
-                if fn == filename:
-                    lineno = int(xs[1])
-                    current_result = None
-                elif current_result == None:
-                    current_result = []
-                    # search for matching include statement
-                    for inc_no in range(lineno-1, len(orig_txt_lines)):
-                        if re.match('#include.*' + os.path.basename(fn), orig_txt_lines[inc_no]):
-                            include_statements.append(orig_txt_lines[inc_no])
-                    include_code.append(current_result)
-            else:
-                if current_result == None:
-                    lineno += 1
-                else:
-                    current_result.append(line)
-        return (include_statements, include_code)
-
-def compare_asts(ast1, ast2):
-	if type(ast1) != type(ast2):
-		return False
-
-	# In the function block, calls of inline function may be expanded.
-	# We shouldn't depend on the way they are expanded but only on the function name.
-	# At least, the function call is added a new argument "namespace" then
-	# we can't use pure equality of ASTs here.
-	if isinstance(ast1, c_ast.FuncDef) and isinstance(ast2, c_ast.FuncDef):
-		return ast1.decl.name == ast2.decl.name
-
-	if isinstance(ast1, tuple) and isinstance(ast2, tuple):
-		if ast1[0] != ast2[0]:
-			return False
-		ast1 = ast1[1]
-		ast2 = ast2[1]
-		return compare_asts(ast1, ast2)
-
-	for attr in ast1.attr_names:
-		if getattr(ast1, attr) != getattr(ast2, attr):
-			return False
-
-	if len(ast1.children()) != len(ast2.children()):
-		return False
-
-	for c1, c2 in zip(ast1.children(), ast2.children()):
-		if compare_asts(c1, c2) == False:
-			return False
-
-	return True
-
-class ASTDiff:
-	def __init__(self):
-		self.asts = [] # [[ast, count]]
-
-	def inc(self, ast):
-		for e in self.asts:
-			if compare_asts(e[0], ast):
-				e[1] += 1
-				return
-		self.asts.append([ast, 1])
-
-	def dec(self, ast):
-		"""
-		Return true iff the ast exists (count > 0)
-		"""
-		for e in self.asts:
-			if compare_asts(e[0], ast):
-				if (e[1] > 0):
-					e[1] -= 1
-					return True
-				else:
-					return False
-		return False
-
-def ast_delete(a, b):
+	in_include = False
+	include_statements = []
+	lineno = 0
+	orig_txt_lines = orig_txt.splitlines()
+
+	for line in txt.splitlines():
+		if line.startswith("#line"):
+			xs = line.split()
+			fn = xs[2].strip('"')
+			fn = fn.replace('\\\\', '\\')
+			if fn == filename:
+				lineno = int(xs[1])
+				in_include = False
+			elif not in_include:
+				in_include = True
+				# search for matching include statement
+				for inc_no in range(lineno-1, len(orig_txt_lines)):
+					if re.match('#include.*' + os.path.basename(fn), orig_txt_lines[inc_no]):
+						include_statements.append(orig_txt_lines[inc_no])
+		else:
+			if not in_include:
+				lineno += 1
+	return include_statements
+
+def ast_delete(ast, files):
 	"""
-	AST-level deletion
-	a -= b 
+	AST-level deletion of the top-level nodes that come from the files.
 
-	Assumes that header directives are listed
-	at the head of the target file.
+	The nodes are tagged with their origins by the line markers
+	while parsing (see ext_pycparser.origin) so we don't need to
+	parse the files again and compare the ASTs.
 	"""
-	diff = ASTDiff()
-
-	for n in b.ext:
-		diff.inc(n)
-
-	delete_indices = []
-	for i, n in enumerate(a.ext):
-		if diff.dec(n):
-			delete_indices.append(i)
-
-	for i in reversed(delete_indices):
-		del(a.ext[i])
+	files = set([os.path.realpath(fn) for fn in files])
+	def fromFiles(n):
+		fn = ext_pycparser.origin(n)
+		return fn is not None and os.path.realpath(fn) in files
+	ext = []
+	for n in ast.ext:
+		if isinstance(n, ext_pycparser.Aside): # The nodes aside may come from several files
+			nodes = [m for m in n.nodes if not fromFiles(m)]
+			if len(nodes) != len(n.nodes):
+				n.nodes = nodes
+				n.text = {}
+			if not nodes:
+				continue
+		elif fromFiles(n):
+			continue
+		ext.append(n)
+	ast.ext = ext
 
 class Apply:
 	"""
@@ -141,29 +87,28 @@ class Apply:
 	"""
 	def __init__(self, f):
 		self.f = f
+		self.deps = []
 
-	def on(self, filename):
-		cpped_txt = cpp(filename)
+	def on(self, filename, cpped_txt=None):
+		"""
+		cpped_txt: the file already preprocessed (default: by mcpp)
+		"""
+		if cpped_txt is None:
+			cpped_txt = cpp(filename)
 		recorder.t.file_record("preprocessed", cpped_txt)
-		# print(cpped_txt)
+		self.deps = utils.included_files(cpped_txt)
 
-                fp = open(filename)
-                orig_txt = fp.read()
-                fp.close()
-
-		(included_headers, included_code) = analyzeInclude(filename, cpped_txt, orig_txt)
-                included_codes=[];
-                for inc_code in included_code:
-                        included_codes('\n'.join(inc_code))
-
-		# print(includes)
+		fp = open(filename)
+		orig_txt = fp.read()
+		fp.close()
 
+		included_headers = analyzeInclude(filename, cpped_txt, orig_txt)
 
 		ast_a = self.f(cpped_txt)
 
-		ast_b = ext_pycparser.ast_of('\n'.join(included_codes))
-		ast_delete(ast_a, ast_b)
-		recorder.t.file_record("delete_included_decls", ext_pycparser.CGenerator().visit(ast_a))
+		# The included code is revived by the include directives.
+		ast_delete(ast_a, [fn for fn in self.deps if fn != filename])
+		recorder.t.file_record("delete_included_decls", ast_a)
 
 		contents = ext_pycparser.CGenerator().visit(ast_a)
 
@@ -176,6 +121,12 @@ class Apply:
 		recorder.t.file_record("union_header_directives", contents)
 		return contents
 
+gnu_testcase = r"""#include "a.h"
+int counter;
+static inline void add(struct pt *p, myint k) { p->x += k; counter++; }
+int main(void) { struct pt p = { 1, 2 }; add(&p, 3); return p.x + counter; }
+"""
+
 if __name__ == "__main__":
 	testcase = r"""
 #line 1 "main.c"
@@ -214,36 +165,32 @@ typedef long mylong;
 
 int main(void) { return 0; }
 """	
-	analyzeInclude("main.c", testcase, testcase)
-
-	a = r"""
-int x1;
-int x2;
-struct T1 { int x; };
-struct T2 { int x; };
-typedef int int1;
-typedef int int2;
-struct f;
-void f1();
-void f1() {}
-void f2() {}
-
-int main()
-{
-	return 0;
-}
-"""
-	ast_a = ext_pycparser.ast_of(a)
-
-	b = r"""
-int x1;
-struct T1 { int x; };
-typedef int int1;
-void f1() {}
-void f2();
-typedef struct T3 { int x; } t3;
-typedef int int1;
-"""
-	ast_b = ext_pycparser.ast_of(b)
-
-	ast_delete(ast_a, ast_b)
+	print(analyzeInclude("main.c", testcase, testcase))
+
+	ast = ext_pycparser.ast_of("typedef int __builtin_va_list;\n" + testcase)
+	ast_delete(ast, ["/usr/lib/gcc/x86_64-linux-gnu/4.7/include/stdarg.h", "a.h", "b.h", "f/g.h"])
+	ast.show()
+
+	# The nodes set aside are deleted as well.
+	import rewrite
+	ast = ext_pycparser.ast_of("typedef int __builtin_va_list;\n" + testcase)
+	rewrite.isolateHeaders(ast, "main.c")
+	ast_delete(ast, ["/usr/lib/gcc/x86_64-linux-gnu/4.7/include/stdarg.h", "a.h", "b.h", "f/g.h"])
+	print(ext_pycparser.CGenerator().visit(ast))
+
+	# --dialect=gnu leaves the nodes aside in the output.
+	# Those from the headers are revived by the include directives only.
+	d = "/tmp/%s" % utils.randstr(16)
+	os.mkdir(d)
+	fn = os.path.join(d, "main.c")
+	with open(os.path.join(d, "a.h"), "w") as fp:
+		fp.write("struct pt { int x, y; };\ntypedef int myint;\nextern int counter;\n")
+	with open(fn, "w") as fp:
+		fp.write(gnu_testcase)
+	cfg.t.dialect = "gnu"
+	cpped_txt = "\n".join(['#line 1 "%s"' % fn, '#line 1 "%s" 1' % os.path.join(d, "a.h")] +
+		open(os.path.join(d, "a.h")).read().splitlines() + ['#line 2 "%s" 2' % fn] + gnu_testcase.splitlines()[1:])
+	print(Apply(lambda txt: rewrite.Wrap(txt).run()).on(fn, cpped_txt))
+	for x in os.listdir(d):
+		os.remove(os.path.join(d, x))
+	os.rmdir(d)
@@ -0,0 +1,444 @@
+from pycparser import c_ast
+
+import ext_pycparser
+import recorder
+import rewrite
+
+class Function:
+	"""
+	The value of a name known to be the function.
+	"""
+	def __init__(self, name):
+		self.name = name
+
+class Object:
+	"""
+	The value of a name known to be the array or the struct initialized by init.
+	The initializer is read in the scopes where the object is declared.
+	"""
+	def __init__(self, init, ty, const, scopes):
+		self.init = init
+		self.ty = ty
+		self.const = const
+		self.scopes = scopes
+
+def integer(n):
+	"""
+	Constant -> int or None
+	"""
+	if not isinstance(n, c_ast.Constant) or n.type != "int":
+		return None
+	try:
+		return int(n.value.rstrip("uUlL"), 0)
+	except ValueError:
+		return None
+
+def root(n):
+	"""
+	The variable the lvalue is a part of (x, x[i], x.f -> x). None if through a pointer.
+	"""
+	while isinstance(n, (c_ast.ArrayRef, c_ast.StructRef)):
+		if isinstance(n, c_ast.StructRef) and n.type == "->":
+			return None
+		n = n.name
+	if isinstance(n, c_ast.ID):
+		return n.name
+	return None
+
+def path(n):
+	"""
+	Expression -> (name, [key]) or None
+
+	x[1].f -> ("x", [1, "f"])
+	"""
+	keys = []
+	while not isinstance(n, c_ast.ID):
+		if isinstance(n, c_ast.ArrayRef):
+			key = integer(n.subscript)
+			if key is None:
+				return None
+			keys.insert(0, key)
+		elif isinstance(n, c_ast.StructRef) and n.type == ".":
+			keys.insert(0, n.field.name)
+		else:
+			return None
+		n = n.name
+	return n.name, keys
+
+def lookup(scopes, name):
+	for scope in reversed(scopes):
+		if name in scope:
+			return scope[name]
+	return None
+
+class Writes(ext_pycparser.NodeVisitor):
+	"""
+	The names of the variables that may be modified.
+	They are assigned, incremented, decremented or their addresses are taken.
+	"""
+	def __init__(self):
+		self.result = set()
+
+	def visit_Assignment(self, n):
+		self.result.add(root(n.lvalue))
+		self.generic_visit(n)
+
+	def visit_UnaryOp(self, n):
+		if n.op in ("++", "--", "p++", "p--", "&"):
+			self.result.add(root(n.expr))
+		self.generic_visit(n)
+
+class Uses(ext_pycparser.NodeVisitor):
+	"""
+	name -> (times referred, times called as f(...))
+	"""
+	def __init__(self):
+		self.result = {}
+
+	def count(self, name, i):
+		uses = self.result.setdefault(name, [0, 0])
+		uses[i] += 1
+
+	def visit_ID(self, n):
+		self.count(n.name, 0)
+
+	def visit_FuncCall(self, n):
+		if isinstance(n.name, c_ast.ID):
+			self.count(n.name.name, 1)
+		self.generic_visit(n)
+
+class Structs(ext_pycparser.NodeVisitor):
+	"""
+	The definitions of the structs and the unions (with the fields).
+	"""
+	def __init__(self):
+		self.result = {} # (class, name) -> node
+
+	def visit_Struct(self, n):
+		if n.name and n.decls is not None:
+			self.result[(n.__class__, n.name)] = n
+		self.generic_visit(n)
+
+	def visit_Union(self, n):
+		self.visit_Struct(n)
+
+class Resolve(ext_pycparser.NodeVisitor):
+	"""
+	Resolves the callees of the calls in a function with the scopes.
+	The calls found are (call, callee, [argument]) where the callee and
+	the arguments are the names of the functions or None if unknown.
+	"""
+	def __init__(self, main, func, params):
+		self.main = main
+		self.calls = []
+		self.writes = ext_pycparser.Result(Writes()).visit(func.body)
+		scope = {}
+		if not ext_pycparser.FuncDef(func).voidArgs():
+			for i, param in enumerate(func.decl.type.args.params):
+				if isinstance(param, c_ast.Decl):
+					scope[param.name] = params.get(i)
+		self.scopes = [main.globals, scope]
+
+	def visit_Compound(self, n):
+		self.scopes.append({})
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
+		self.scopes.pop()
+
+	def visit_Decl(self, n):
+		if n.init is not None:
+			self.walk(n.init, ext_pycparser.Slot(n, "init"))
+		const = n.name not in self.writes
+		self.scopes[-1][n.name] = self.main.value(n, const, self.scopes)
+
+	def visit_DeclList(self, n):
+		# for (T x = ...; ...) The scope is the loop.
+		for decl in n.decls:
+			if decl.init is not None:
+				self.visit(decl.init)
+			self.scopes[-1][decl.name] = None
+
+	def visit_FuncCall(self, n):
+		callee = self.main.function(n.name, self.scopes)
+		if callee and not isinstance(lookup(self.scopes, callee), Function): # Hidden by a variable
+			callee = None
+		args = [self.main.function(arg, self.scopes) for arg in (n.args.exprs if n.args else [])]
+		self.calls.append((n, callee, args))
+		self.generic_visit(n)
+
+class Main:
+	"""
+	AST -> AST
+
+	Rewrites the calls through the function pointers of the known values
+	into the direct calls so that they can be macroized.
+
+	static int (*const ops[])(int) = { f, g };  ops[1](x)      -> g(x)
+	static const struct ops o = { .run = f };   o.run(x)       -> f(x)
+	int (*h)(int) = f; (h never modified)       h(x), (*h)(x)  -> f(x)
+	static void run(void (*h)(void)) { h(); } only called as run(g) -> g();
+
+	The values are known if the objects are const or never modified
+	(static or local and the addresses are never taken).
+	"""
+	def __init__(self, ast):
+		self.ast = ast
+		self.globals = {} # name -> Function, Object or None (unknown)
+		self.structs = {}
+
+	def nodes(self):
+		"""
+		The top-level nodes including those set aside
+		"""
+		for n in self.ast.ext:
+			if isinstance(n, ext_pycparser.Aside):
+				for m in n.nodes:
+					yield m
+			else:
+				yield n
+
+	def resolve(self, ty):
+		"""
+		(type, const) through the typedefs
+		"""
+		const = "const" in getattr(ty, "quals", [])
+		while isinstance(ty, c_ast.TypeDecl) and isinstance(ty.type, c_ast.IdentifierType) \
+				and ty.type.names[-1] in rewrite.t.typedefs:
+			ty = rewrite.t.typedefs[ty.type.names[-1]].type
+			const = const or "const" in getattr(ty, "quals", [])
+		return ty, const
+
+	def functionPointer(self, ty):
+		ty, _ = self.resolve(ty)
+		return isinstance(ty, c_ast.PtrDecl) and isinstance(self.resolve(ty.type)[0], c_ast.FuncDecl)
+
+	def fields(self, ty):
+		"""
+		The fields of the struct or the union type. None if not known.
+		"""
+		if not isinstance(ty, c_ast.TypeDecl) or not isinstance(ty.type, (c_ast.Struct, c_ast.Union)):
+			return None
+		decls = ty.type.decls
+		if decls is None:
+			definition = self.structs.get((ty.type.__class__, ty.type.name))
+			decls = definition.decls if definition else None
+		return decls
+
+	def element(self, init, ty, key):
+		"""
+		The initializer of init[key] (or init.key) and its type. None if not known.
+		"""
+		ty, const = self.resolve(ty)
+		if isinstance(key, int):
+			if not isinstance(ty, c_ast.ArrayDecl):
+				return None
+			names = None
+			index = key
+			elty = ty.type
+		else:
+			fields = self.fields(ty)
+			names = [field.name for field in fields or []]
+			if not key in names:
+				return None
+			index = names.index(key)
+			elty = fields[index].type
+		if not isinstance(init, c_ast.InitList):
+			return None
+
+		found = None
+		i = 0
+		for e in init.exprs:
+			if isinstance(e, c_ast.NamedInitializer): # .f = x, [1] = x
+				if len(e.name) != 1:
+					return None
+				designator = e.name[0]
+				if isinstance(designator, c_ast.ID) and names is not None and designator.name in names:
+					i = names.index(designator.name)
+				elif names is None and integer(designator) is not None:
+					i = integer(designator)
+				else:
+					return None
+				e = e.expr
+			if i == index:
+				found = e
+			i += 1
+		if found is None:
+			return None
+		return found, elty, const
+
+	def function(self, n, scopes):
+		"""
+		The name of the function the expression is known to be. None if not known.
+		"""
+		while isinstance(n, c_ast.UnaryOp) and n.op in ("*", "&"): # (*f)(x), &f
+			n = n.expr
+		p = path(n)
+		if p is None:
+			return None
+		name, keys = p
+		value = lookup(scopes, name)
+		if isinstance(value, Function) and not keys:
+			return value.name
+		if not isinstance(value, Object) or not keys:
+			return None
+
+		init, ty, const = value.init, value.ty, value.const
+		for key in keys:
+			found = self.element(init, ty, key)
+			if found is None:
+				return None
+			init, ty, elconst = found
+			const = const or elconst
+		if not (const or self.resolve(ty)[1]) or not self.functionPointer(ty):
+			return None
+		return self.function(init, value.scopes)
+
+	def value(self, decl, unmodified, scopes):
+		"""
+		The value of the declared name
+		"""
+		if isinstance(decl.type, c_ast.FuncDecl):
+			return Function(decl.name)
+		if decl.init is None:
+			return None
+		ty, const = self.resolve(decl.type)
+		const = const or "const" in decl.quals
+		if self.functionPointer(decl.type):
+			if const or unmodified:
+				name = self.function(decl.init, scopes)
+				return Function(name) if name else None
+			return None
+		if isinstance(ty, c_ast.ArrayDecl) or self.fields(ty) is not None:
+			# The storage is shared by the pointers to it. The elements
+			# can be modified through them unless they are const.
+			return Object(decl.init, decl.type, const, [dict(scope) for scope in scopes])
+		return None
+
+	def setupGlobals(self):
+		writes = Writes()
+		uses = Uses()
+		structs = Structs()
+		for n in self.nodes():
+			writes.visit(n)
+			uses.visit(n)
+			structs.visit(n)
+		self.structs = structs.result
+		self.uses = uses.result
+
+		for n in self.nodes():
+			if isinstance(n, c_ast.FuncDef):
+				self.globals[n.decl.name] = Function(n.decl.name)
+			elif isinstance(n, c_ast.Decl) and n.name:
+				# The other files may modify the globals not static.
+				unmodified = not n.name in writes.result and "static" in n.storage
+				self.globals[n.name] = self.value(n, unmodified, [self.globals])
+			elif isinstance(n, c_ast.Typedef):
+				self.globals.pop(n.name, None)
+
+	def resolveAll(self, params):
+		calls = []
+		for _, func in sorted(rewrite.t.all_funcs.values()):
+			resolve = Resolve(self, func, params.get(func.decl.name, {}))
+			resolve.visit(func.body)
+			calls.extend(resolve.calls)
+		return calls
+
+	def propagate(self, calls):
+		"""
+		name -> {index -> Function}
+
+		The params of the static functions taking the same function
+		at all the calls. The functions must not be referred other than
+		called so all their calls are known.
+		"""
+		args = {} # name -> [[argument]]
+		for call, callee, values in calls:
+			if isinstance(call.name, c_ast.ID):
+				args.setdefault(call.name.name, []).append(values)
+
+		params = {}
+		for name, (_, func) in rewrite.t.all_funcs.items():
+			if not "static" in func.decl.storage or not name in args:
+				continue
+			referred, called = self.uses.get(name, (0, 0))
+			if referred != called or called != len(args[name]) or ext_pycparser.FuncDef(func).voidArgs():
+				continue
+			writes = ext_pycparser.Result(Writes()).visit(func.body)
+			for i, param in enumerate(func.decl.type.args.params):
+				if not isinstance(param, c_ast.Decl) or param.name in writes or not self.functionPointer(param.type):
+					continue
+				values = set([vs[i] if i < len(vs) else None for vs in args[name]])
+				if len(values) == 1 and None not in values:
+					params.setdefault(name, {})[i] = Function(values.pop())
+		return params
+
+	def run(self):
+		self.setupGlobals()
+
+		# The params found make more arguments known.
+		params = {}
+		while True:
+			calls = self.resolveAll(params)
+			found = self.propagate(calls)
+			if sorted(found) == sorted(params) and \
+					all(sorted(found[k]) == sorted(params[k]) for k in found):
+				break
+			params = found
+
+		rewritten = False
+		for call, callee, _ in calls:
+			if callee is None:
+				continue
+			if isinstance(call.name, c_ast.ID) and call.name.name == callee:
+				continue
+			call.name = c_ast.ID(callee, call.name.coord)
+			rewritten = True
+		if rewritten:
+			recorder.t.file_record("devirtualize", self.ast)
+		return self
+
+	def returnAST(self):
+		return self.ast
+
+test_file = r"""
+int f(int x) { return x + 1; }
+int g(int x) { return x * 2; }
+typedef int (*op_t)(int);
+struct ops { op_t run; int (*stop)(int); };
+
+static int (*const table[])(int) = { f, &g };
+static const op_t named[3] = { [2] = g, [0] = f };
+static const struct ops o = { .stop = f, .run = g };
+static const struct ops os[] = { { f, g }, { g, f } };
+static int (*hook)(int) = g;
+static int (*changed)(int) = f;
+op_t shared = f;
+
+static inline int apply(op_t h, int x) { return h(x) + (*h)(x); }
+static inline int apply2(op_t h, int x) { return apply(h, x); }
+
+int main(void)
+{
+	int (*local)(int) = f;
+	int (*alias)(int) = table[1];
+	int (*moved)(int) = f;
+	int i = 0;
+	moved = g;
+	changed = g;
+	i += table[0](1) + (*table[1])(2) + named[2](3) + named[i](4);
+	i += o.run(5) + o.stop(6) + os[1].run(7) + os[0].stop(8);
+	i += local(9) + alias(10) + moved(11) + hook(12) + changed(13) + shared(14);
+	i += apply(f, 15) + apply2(f, 16);
+	{
+		int f = 0;
+		i += local(17) + f;
+	}
+	return i;
+}
+"""
+
+if __name__ == "__main__":
+	ast = ext_pycparser.ast_of(test_file)
+	rewrite.t.setupAST(ast)
+	print ext_pycparser.CGenerator().visit(ast)
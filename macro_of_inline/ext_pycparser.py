@@ -1,5 +1,6 @@
 from pycparser import c_ast, c_parser, c_generator
 
+import copy
 import enum
 import re
 
@@ -11,10 +12,72 @@ class Result:
 		self.visitor.visit(n)
 		return self.visitor.result
 
-def ast_of(txt):
-	parser = c_parser.CParser()
+# Typedef names the parser knows in advance (see CParser)
+TYPEDEFS = set()
+
+# Names the lexer takes as type qualifiers (the placeholders of gnu)
+QUALIFIERS = set()
+
+class Keywords(dict):
+	def get(self, name, default=None):
+		if name in QUALIFIERS:
+			return "VOLATILE"
+		return dict.get(self, name, default)
+
+class CParser(c_parser.CParser):
+	"""
+	The parser knows TYPEDEFS as if they were declared at the head of the text.
+	We don't need to include the fake typedefs into the text to parse it.
+	So are the typedefs of the text before (see ast_of).
+	"""
+	def __init__(self):
+		c_parser.CParser.__init__(self)
+		self.clex.keyword_map = Keywords(self.clex.keyword_map)
+		self.typedefs = set()
+
+	def _is_type_in_scope(self, name):
+		for scope in reversed(self._scope_stack):
+			# Shadowed by the identifier of the same name
+			in_scope = scope.get(name)
+			if in_scope is not None:
+				return in_scope
+		return name in TYPEDEFS or name in self.typedefs
+
+parser = None
+def ast_of(txt, typedefs=frozenset()):
+	"""
+	typedefs: the typedef names declared before the text
+	"""
+	global parser
+	if parser is None: # Building the parser isn't cheap
+		parser = CParser()
+	parser.typedefs = typedefs
+	parser.clex.lexer.begin('INITIAL') # Left in a directive if the last parse failed
 	return parser.parse(txt)
 
+def typedef_names(txt):
+	"""
+	Text -> set(name)
+
+	The directives and comments in the text are ignored.
+	"""
+	txt = re.sub(r'/\*.*?\*/', ' ', txt, flags=re.S)
+	txt = re.sub(r'//.*', '', txt)
+	lines = [line for line in txt.splitlines() if not line.lstrip().startswith("#")]
+	return set([n.name for n in ast_of('\n'.join(lines)).ext if isinstance(n, c_ast.Typedef)])
+
+# Origin of the nodes created by this program
+GENERATED = "<generated>"
+
+def origin(n):
+	"""
+	The file the node comes from.
+	The parser tracks the line markers (#line N "file") in its coords.
+	"""
+	if n.coord is None:
+		return None
+	return n.coord.file
+
 class Any(c_ast.Node):
 	"""
 	Any node contains any text representation.
@@ -29,6 +92,23 @@ class Any(c_ast.Node):
 
 	attr_names = ('text',)
 
+class Aside(c_ast.Node):
+	"""
+	Aside node holds top-level nodes that no rewrite needs to visit
+	(e.g. declarations from the headers). It has no children so the
+	visitors skip it but it's generated as the nodes it holds.
+	"""
+	def __init__(self, nodes, coord=None):
+		self.nodes = nodes
+		self.coord = coord
+		self.text = {} # linemarkers -> generated text
+
+	def children(self):
+		nodelist = []
+		return tuple(nodelist)
+
+	attr_names = ()
+
 class CommaOp(c_ast.Node):
 	def __init__(self, exprs, coord=None):
 		self.exprs = exprs
@@ -40,6 +120,17 @@ class CommaOp(c_ast.Node):
 
 	attr_names = ('exprs',)
 
+# The nodes of the expressions. Their upstream visit_X only visit the children.
+EXPRESSIONS = (c_ast.BinaryOp, c_ast.UnaryOp, c_ast.TernaryOp, c_ast.Assignment, c_ast.Cast,
+               c_ast.FuncCall, c_ast.ArrayRef, c_ast.StructRef, c_ast.ExprList, c_ast.InitList,
+               c_ast.NamedInitializer)
+
+# The statements followed by ; in _generate_stmt
+SIMPLE_STATEMENTS = (c_ast.Decl, c_ast.Assignment, c_ast.Cast, c_ast.UnaryOp,
+                     c_ast.BinaryOp, c_ast.TernaryOp, c_ast.FuncCall, c_ast.ArrayRef,
+                     c_ast.StructRef, c_ast.Constant, c_ast.ID, c_ast.Typedef,
+                     c_ast.ExprList)
+
 class CGenerator(c_generator.CGenerator):
 	"""
 	Since we don't modify the upstream CGenerator
@@ -56,9 +147,147 @@ class CGenerator(c_generator.CGenerator):
 	strict ISO standard. '-pedantic' option of gcc compiler
 	can warn this.
 	"""
+	def __init__(self, linemarkers=False):
+		c_generator.CGenerator.__init__(self)
+		self.linemarkers = linemarkers
+		self.memo = {} # id(node) -> text of the subexpressions generated
+
+	def visit(self, n):
+		if id(n) in self.memo:
+			return self.memo[id(n)]
+		if isinstance(n, EXPRESSIONS):
+			return self.expression(n)
+		return c_generator.CGenerator.visit(self, n)
+
+	def expression(self, n):
+		"""
+		The subexpressions are generated before the expressions having
+		them (without recursion) and the upstream visit_X find their texts
+		in the memo. a + b + ... + z is nested as deep as it is long.
+		"""
+		order = []
+		stack = [n]
+		while stack:
+			x = stack.pop()
+			order.append(x)
+			stack.extend([c for _, c in x.children() if isinstance(c, EXPRESSIONS) and not id(c) in self.memo])
+		for x in reversed(order):
+			self.memo[id(x)] = c_generator.CGenerator.visit(self, x)
+		result = self.memo[id(n)]
+		for x in order:
+			self.memo.pop(id(x), None)
+		return result
+
+	def visit_Compound(self, n):
+		"""
+		The statements are generated with a stack of our own. The upstream
+		recurses over the nesting (e.g. long else-if chains).
+		The items of the stack are
+
+		text
+		function returning the text (called at the indent level of the time)
+		("margin", text): the text indented
+		("indent", delta)
+		("stmt", node, add_indent): _generate_stmt(node, add_indent)
+		("node", node): visit(node) of the statement
+		"""
+		out = []
+		stack = [("node", n)]
+		while stack:
+			item = stack.pop()
+			if isinstance(item, str):
+				out.append(item)
+			elif callable(item):
+				out.append(item())
+			elif item[0] == "margin":
+				out.append(self._make_indent() + item[1])
+			elif item[0] == "indent":
+				self.indent_level += item[1]
+			elif item[0] == "stmt":
+				stack.extend(reversed(self.stmtItems(item[1], item[2])))
+			else:
+				stack.extend(reversed(self.nodeItems(item[1])))
+		return ''.join(out)
+
+	def stmtItems(self, n, add_indent):
+		"""
+		Same as the upstream _generate_stmt
+		"""
+		indent = ' ' * (self.indent_level + (2 if add_indent else 0))
+		if type(n) is c_ast.Compound:
+			return [("node", n)]
+		if type(n) in SIMPLE_STATEMENTS:
+			return [indent, lambda: self.visit(n), ';\n']
+		return [indent, ("node", n), '\n']
+
+	def nodeItems(self, n):
+		"""
+		Same as the upstream visit_X of the statements having statements
+		"""
+		visit = lambda x: self.visit(x) if x else ''
+		if type(n) is c_ast.Compound:
+			return ([("margin", '{\n'), ("indent", 2)] +
+			        [("stmt", x, False) for x in n.block_items or []] +
+			        [("indent", -2), ("margin", '}\n')])
+		if type(n) is c_ast.If:
+			items = [lambda: 'if (' + visit(n.cond) + ')\n', ("stmt", n.iftrue, True)]
+			if n.iffalse:
+				items += [("margin", 'else\n'), ("stmt", n.iffalse, True)]
+			return items
+		if type(n) is c_ast.For:
+			head = lambda: 'for (' + visit(n.init) + ';' + (' ' + visit(n.cond) if n.cond else '') + ';' + (' ' + visit(n.next) if n.next else '') + ')\n'
+			return [head, ("stmt", n.stmt, True)]
+		if type(n) is c_ast.While:
+			return [lambda: 'while (' + visit(n.cond) + ')\n', ("stmt", n.stmt, True)]
+		if type(n) is c_ast.DoWhile:
+			return ['do\n', ("stmt", n.stmt, True), ("margin", 'while ('), lambda: visit(n.cond) + ');']
+		if type(n) is c_ast.Switch:
+			return [lambda: 'switch (' + self.visit(n.cond) + ')\n', ("stmt", n.stmt, True)]
+		if type(n) is c_ast.Case:
+			return [lambda: 'case ' + self.visit(n.expr) + ':\n'] + [("stmt", x, True) for x in n.stmts]
+		if type(n) is c_ast.Default:
+			return ['default:\n'] + [("stmt", x, True) for x in n.stmts]
+		if type(n) is c_ast.Label:
+			return [n.name + ':\n', ("stmt", n.stmt, False)]
+		return [lambda: self.visit(n)]
+
+	def visit_FileAST(self, n):
+		"""
+		With linemarkers, each top-level node is preceded by #line
+		of its origin so the origins survive the text round-trip.
+		"""
+		s = ''
+		for ext in n.ext:
+			if isinstance(ext, Aside):
+				s += self.visit(ext)
+				continue
+			if self.linemarkers:
+				s += '#line 1 "%s"\n' % (origin(ext) or GENERATED)
+			s += c_generator.CGenerator.visit_FileAST(self, c_ast.FileAST([ext]))
+		return s
+
+	def visit_Aside(self, n):
+		"""
+		The nodes aside are rarely modified so the text is generated once.
+		Modifying them needs resetting n.text.
+		"""
+		if not self.linemarkers in n.text:
+			n.text[self.linemarkers] = self.visit(c_ast.FileAST(n.nodes))
+		return n.text[self.linemarkers]
+
 	def visit_Any(self, n):
 		return n.text
 
+	def _generate_decl(self, n):
+		"""
+		struct S { ... } volatile; -> volatile struct S { ... };
+		The qualifiers are lost otherwise (e.g. the attributes of gnu).
+		"""
+		s = c_generator.CGenerator._generate_decl(self, n)
+		if isinstance(n.type, (c_ast.Struct, c_ast.Union, c_ast.Enum)) and n.quals:
+			s = ' '.join(n.quals) + ' ' + s
+		return s
+
 	def visit_CommaOp(self, n):
 		return "(" + self.visit(n.exprs) + ")"
 
@@ -69,34 +298,249 @@ class CGenerator(c_generator.CGenerator):
 		"""
 		return '\n'.join([line for line in txt.splitlines() if line != ";"])
 
+# node class -> names of the attributes holding the children
+CHILD_ATTRS = {}
+
+def child_attrs(node_class):
+	if node_class not in CHILD_ATTRS:
+		others = node_class.attr_names + ("coord", "__weakref__")
+		CHILD_ATTRS[node_class] = tuple([attr for attr in node_class.__slots__ if attr not in others])
+	return CHILD_ATTRS[node_class]
+
+class Slot(object):
+	"""
+	The place of a node in its owner: owner.attr or owner.attr[index]
+	"""
+	__slots__ = ("owner", "attr", "index")
+
+	def __init__(self, owner, attr, index=None):
+		self.owner = owner
+		self.attr = attr
+		self.index = index
+
+	def get(self):
+		x = getattr(self.owner, self.attr)
+		return x if self.index is None else x[self.index]
+
+	def replace(self, node):
+		if self.index is None:
+			setattr(self.owner, self.attr, node)
+		else:
+			getattr(self.owner, self.attr)[self.index] = node
+
+	def __repr__(self):
+		if self.index is None:
+			return "%s.%s" % (self.owner.__class__.__name__, self.attr)
+		return "%s.%s[%d]" % (self.owner.__class__.__name__, self.attr, self.index)
+
+def slots_of(node):
+	"""
+	Node -> [Slot]
+
+	The slots of the children in the order of node.children()
+	"""
+	result = []
+	for attr in child_attrs(node.__class__):
+		x = getattr(node, attr)
+		if isinstance(x, list):
+			result.extend([Slot(node, attr, i) for i in range(len(x))])
+		elif x is not None:
+			result.append(Slot(node, attr))
+	return result
+
+def flatten(node):
+	"""
+	AST -> [(node class, {attr: value})]
+
+	The nodes in a list. The children are the indices of the list
+	(None if missing) so pickle or deepcopy of it doesn't recurse over
+	the depth of the AST. The shared nodes stay shared. The nodes of
+	our own (e.g. Any) are put as they are with None as the class.
+	"""
+	nodes = [node]
+	index = {id(node): 0}
+	def ref(n):
+		if n is None:
+			return None
+		if not id(n) in index:
+			index[id(n)] = len(nodes)
+			nodes.append(n)
+		return index[id(n)]
+
+	result = []
+	for n in nodes: # Grows in the loop
+		if not "__slots__" in n.__class__.__dict__:
+			result.append((None, n))
+			continue
+		children = child_attrs(n.__class__)
+		state = {}
+		for attr in n.__class__.__slots__:
+			if attr == "__weakref__":
+				continue
+			x = getattr(n, attr)
+			if attr in children:
+				x = [ref(c) for c in x] if isinstance(x, list) else ref(x)
+			state[attr] = x
+		result.append((n.__class__, state))
+	return result
+
+def unflatten(flat):
+	"""
+	[(node class, {attr: value})] -> AST
+	"""
+	nodes = [n if cls is None else cls.__new__(cls) for cls, n in flat]
+	for n, (cls, state) in zip(nodes, flat):
+		if cls is None:
+			continue
+		children = child_attrs(cls)
+		for attr, x in state.items():
+			if attr in children:
+				x = [nodes[i] for i in x] if isinstance(x, list) else (None if x is None else nodes[x])
+			setattr(n, attr, x)
+	return nodes[0]
+
+def copy_ast(node):
+	"""
+	copy.deepcopy(node) without the recursion over the depth of the AST
+	"""
+	return unflatten(copy.deepcopy(flatten(node)))
+
+class Edits:
+	"""
+	Insertions into a list of nodes (e.g. Compound.block_items).
+	They are spliced in one pass by apply(). Until then the list doesn't
+	move so the indices (slots) stay valid.
+	The nodes inserted at the same place are in the order of the calls.
+	"""
+	def __init__(self, nodes):
+		self.nodes = nodes
+		self.first = [] # Before everything (e.g. declarations)
+		self.before = {} # index -> [node]
+		self.after = {} # index -> [node]
+
+	def insertFirst(self, node):
+		self.first.append(node)
+
+	def insertBefore(self, i, node):
+		self.before.setdefault(i, []).append(node)
+
+	def insertAfter(self, i, node):
+		self.after.setdefault(i, []).append(node)
+
+	def apply(self):
+		result = list(self.first)
+		for i, x in enumerate(self.nodes):
+			result.extend(self.before.get(i, []))
+			result.append(x)
+			result.extend(self.after.get(i, []))
+		self.nodes[:] = result
+
+# (visitor class, node class) -> (enter hook, leave hook)
+HOOKS = {}
+
+def hooks_of(visitor_class, node_class):
+	key = (visitor_class, node_class)
+	if key not in HOOKS:
+		name = node_class.__name__
+		HOOKS[key] = (getattr(visitor_class, "visit_" + name, visitor_class.generic_visit),
+		              getattr(visitor_class, "leave_" + name, None))
+	return HOOKS[key]
+
 class NodeVisitor(c_ast.NodeVisitor):
+	"""
+	Traversal with an explicit stack. The depth of the AST (long else-if
+	chains, deeply nested expressions) is not limited by the Python stack.
+
+	visit_X(n) is called on entering a node of class X (generic_visit(n)
+	if not defined). The hook chooses the children to go down by calling
+	self.generic_visit(n) (all the children) or self.visit(c) (a child).
+	They are visited after the hook returns, in the order of the calls.
+	The children are not visited unless chosen.
+
+	leave_X(n) is called after all the chosen descendants of n are visited.
+
+	In the hooks, current_slot is the Slot of the node (None for the root).
+	The node can be replaced through it. insertFirst/insertBefore/insertAfter
+	put the insertions into the list off until the traversal ends.
+
+	context is the value the hook sees as a local variable of the recursion.
+	The value when a child is chosen is set back when the child and its
+	descendants are visited (e.g. under a condition in rewrite_expr.Effects).
+
+	walk(n) visits the subtree right away even in a hook.
+	"""
+	chosen = None # [(Slot, node, context)] chosen by the running hook. None out of the traversal
+	current_slot = None
+	context = None
 
 	def visit(self, node):
-		if not hasattr(self, "current_parent"):
-			self.current_parent = node
-		c_ast.NodeVisitor.visit(self, node)
+		if self.chosen is None:
+			self.walk(node)
+		else:
+			self.chosen.append((None, node, self.context))
 
 	def generic_visit(self, node):
-		oldparent = self.current_parent
-		self.current_parent = node
-		for c_name, c in node.children():
-			self.current_name = c_name
-			# print("%s.%s = %s" % (self.current_parent, self.current_name, type(c)))
-			self.visit(c)
-		self.current_parent = oldparent
-
-	@classmethod
-	def rewrite(cls, o, name, value):
-		r = re.compile("(\w+)(\[(\d+)\])?")
-		m = r.search(name)
-		assert(m.group(1))
-		attrname = m.group(1)
-		if m.group(2): # o.attr[i]
-			index = int(m.group(3))
-			getattr(o, attrname)[index] = value
-		else: # o.attr
-			setattr(o, attrname, value)
+		if self.chosen is None:
+			for slot in slots_of(node):
+				self.walk(slot.get(), slot)
+		else:
+			self.chosen.extend([(slot, slot.get(), self.context) for slot in slots_of(node)])
+
+	def walk(self, node, slot=None):
+		outermost = self.chosen is None
+		if outermost:
+			self.edits = {} # id(list) -> Edits
+		saved = (self.chosen, self.current_slot, self.context)
+		stack = [(False, node, slot, self.context)]
+		while stack:
+			leaving, n, self.current_slot, self.context = stack.pop()
+			enter, leave = hooks_of(self.__class__, n.__class__)
+			if leaving:
+				leave(self, n)
+				continue
+			self.chosen = []
+			context = self.context
+			enter(self, n)
+			chosen = self.chosen
+			if leave:
+				stack.append((True, n, self.current_slot, context))
+			if any(c_slot is None for c_slot, _, _ in chosen):
+				slots = dict((id(c_slot.get()), c_slot) for c_slot in slots_of(n))
+				chosen = [(c_slot or slots.get(id(c)), c, c_context) for c_slot, c, c_context in chosen]
+			for c_slot, c, c_context in reversed(chosen):
+				stack.append((False, c, c_slot, c_context))
+		self.chosen, self.current_slot, self.context = saved
+		if outermost:
+			for edits in self.edits.values():
+				edits.apply()
+
+	def editsOf(self, slot):
+		nodes = getattr(slot.owner, slot.attr)
+		if id(nodes) not in self.edits:
+			self.edits[id(nodes)] = Edits(nodes)
+		return self.edits[id(nodes)]
+
+	def insertFirst(self, slot, node):
+		self.editsOf(slot).insertFirst(node)
+
+	def insertBefore(self, slot, node):
+		self.editsOf(slot).insertBefore(slot.index, node)
+
+	def insertAfter(self, slot, node):
+		self.editsOf(slot).insertAfter(slot.index, node)
+
+def unconst(ty):
+	"""
+	const T x -> T x
+	T *const p -> T *p
 
+	Only the top-level qualifier is stripped so the variable can be assigned.
+	The attributes (QUALIFIERS) are stripped too. They are of the declaration
+	copied from (e.g. always_inline of the function).
+	"""
+	if isinstance(ty, (c_ast.TypeDecl, c_ast.PtrDecl)):
+		ty.quals = [q for q in ty.quals if q != "const" and not q in QUALIFIERS]
+	return ty
 
 class RewriteTypeDecl(NodeVisitor):
 	def __init__(self, alias):
@@ -265,14 +709,33 @@ class AllFuncCalls(NodeVisitor):
 class FuncCall:
 	pass
 
-class T:
+class AllNames(NodeVisitor):
+	"""
+	Collect all the identifiers in the AST
+	(variables, functions, types, tags, fields and labels).
+	"""
 	def __init__(self):
-		self.xs = [1, 2, 3]
-		self.y = 10
+		self.result = set()
+
+	def generic_visit(self, n):
+		for attr in ("name", "declname"):
+			x = getattr(n, attr, None)
+			if isinstance(x, str):
+				self.result.add(x)
+		if isinstance(n, c_ast.IdentifierType):
+			self.result.update(n.names)
+		NodeVisitor.generic_visit(self, n)
 
 if __name__ == "__main__":
-	t = T()
-	NodeVisitor.rewrite(t, "xs[1]", 4)
-	assert(t.xs[1] == 4)
-	NodeVisitor.rewrite(t, "y", 20)
-	assert(t.y == 20)
+	ast = ast_of("void f(int x) { x = 1; x = 2; }")
+	body = ast.ext[0].body
+	slots = slots_of(body)
+	assert(len(slots) == 2 and slots[1].get() is body.block_items[1])
+	slots[1].replace(c_ast.Return(None))
+	assert(isinstance(body.block_items[1], c_ast.Return))
+	edits = Edits(body.block_items)
+	edits.insertBefore(0, c_ast.EmptyStatement())
+	edits.insertAfter(1, c_ast.Break())
+	edits.insertFirst(c_ast.Continue())
+	edits.apply()
+	assert([m.__class__.__name__ for m in body.block_items] == ["Continue", "EmptyStatement", "Assignment", "Return", "Break"])
@@ -0,0 +1,383 @@
+import ext_pycparser
+import re
+import rewrite
+
+# Preprocessed text. The directives left are the line markers and the pragmas.
+TOKEN = re.compile(r'''
+	\#[^\n]* |
+	\s+ |
+	"(?:\\.|[^"\\\n])*" |
+	'(?:\\.|[^'\\\n])*' |
+	[A-Za-z_$][\w$]* |
+	\.?\d(?:[eEpP][+-]|[\w.])* |
+	\.\.\. | -> | <<= | >>= | [-+*/%&|^!=<>]= | \+\+ | -- | << | >> | && | \|\| |
+	.
+''', re.X | re.S)
+
+NAME = re.compile(r'[A-Za-z_$][\w$]*$')
+
+# The other spellings of the standard keywords
+ALIASES = {
+	"__inline": "inline",
+	"__inline__": "inline",
+	"__const": "const",
+	"__const__": "const",
+	"__volatile": "volatile",
+	"__volatile__": "volatile",
+	"__signed": "signed",
+	"__signed__": "signed",
+}
+
+ATTRIBUTES = ("__attribute__", "__attribute")
+ASMS = ("__asm__", "__asm", "asm")
+ASM_QUALIFIERS = ("volatile", "__volatile__", "__volatile", "goto", "inline", "__inline", "__inline__")
+TYPEOFS = ("__typeof__", "__typeof", "typeof")
+
+# Kept where they are like the type qualifiers
+QUALIFIERS = ("__restrict", "__restrict__", "__thread", "_Thread_local")
+
+# Taking types as the arguments
+BUILTINS = ("__builtin_va_arg", "__builtin_offsetof", "__builtin_types_compatible_p",
+            "__alignof__", "__alignof", "_Alignof")
+
+# Built in the compiler. They are typedef names for the parser.
+TYPES = ("__builtin_va_list", "__int128", "__int128_t", "__uint128_t", "__float128", "__float80",
+         "__fp16", "_Float16", "_Float32", "_Float64", "_Float128", "_Float32x", "_Float64x", "_Float128x")
+
+EXTENSIONS = re.compile(r'\b(?:%s)\b|\(\s*\{' % '|'.join(
+	list(ALIASES) + list(ATTRIBUTES) + list(ASMS) + list(TYPEOFS) + list(QUALIFIERS) +
+	list(BUILTINS) + list(TYPES) + ["__extension__"]))
+
+# Kinds of the placeholders
+PRE = "pre"       # Type qualifier where it is
+POST = "post"     # Type qualifier moved back after the declarator
+TYPE = "type"     # Type qualifier moved back after the struct body
+STMT = "stmt"     # Expression statement
+EXPR = "expr"     # Call without arguments
+DECL = "decl"     # Typedef at the file scope
+TYPEOF = "typeof" # Typedef name
+
+STRUCTS = ("struct", "union", "enum")
+
+class Tokens:
+	"""
+	The significant tokens (not the spaces) of the text with
+	the matching brackets and the depths of the braces.
+	"""
+	def __init__(self, txt):
+		self.all = [m.group(0) for m in TOKEN.finditer(txt)]
+		self.sig = [i for i, tok in enumerate(self.all) if not tok.isspace()]
+		self.match = {}
+		self.depth = []
+		stack = []
+		depth = 0
+		for k, i in enumerate(self.sig):
+			tok = self.all[i]
+			if tok == "}":
+				depth -= 1
+			self.depth.append(depth)
+			if tok == "{":
+				depth += 1
+			if tok in ("(", "[", "{"):
+				stack.append(k)
+			elif tok in (")", "]", "}") and stack:
+				self.match[stack[-1]] = k
+				self.match[k] = stack.pop()
+
+	def __len__(self):
+		return len(self.sig)
+
+	def __getitem__(self, k):
+		"""
+		The k-th significant token. None out of the text.
+		"""
+		if 0 <= k < len(self.sig):
+			return self.all[self.sig[k]]
+		return None
+
+	def boundary(self, k):
+		"""
+		Nothing before the k-th token in the statement
+		"""
+		tok = self[k - 1]
+		return tok is None or tok in (";", "{", "}", ":") or tok.startswith("#")
+
+	def structBody(self, k):
+		"""
+		The k-th token is { of struct, union or enum
+		"""
+		if self[k] != "{":
+			return False
+		return self[k - 1] in STRUCTS or (NAME.match(self[k - 1] or "") and self[k - 2] in STRUCTS)
+
+	def declStart(self, k):
+		"""
+		The first token of the declaration (or the parameter) having the k-th token
+		"""
+		comma = None
+		j = k - 1
+		while j >= 0:
+			tok = self[j]
+			if tok in (")", "]") and j in self.match:
+				j = self.match[j] - 1
+				continue
+			if tok == "}" and j in self.match:
+				o = self.match[j]
+				if self.structBody(o) or self[o - 1] in ("=", ","): # The type or the initializer
+					j = o - 1
+					continue
+				return j + 1
+			if tok == "(": # The parameters
+				return (comma or j) + 1
+			if tok == ",":
+				comma = comma or j
+			if tok in (";", "{", "[") or tok.startswith("#"):
+				return j + 1
+			j -= 1
+		return 0
+
+class Extensions:
+	"""
+	Text -> Text
+
+	With __GNUC__ defined, the headers take the fast paths made of GNU
+	extensions (e.g. __builtin_*, inline asm and always_inline). pycparser
+	can't parse them so they are masked into the placeholders (generated
+	names) before parsing and restored verbatim on output:
+
+	__attribute__((x)) and __restrict -> type qualifiers. Those after the
+	declarators (e.g. the asm labels) are moved to the heads of the
+	declarations and moved back on output. Those of struct types go
+	after the struct bodies.
+	__asm__(...) statements, ({ ... }) and __builtin_va_arg(ap, T) -> calls.
+	__typeof__(x) -> typedef names.
+	__asm__(...) at the file scope -> typedefs.
+
+	The other spellings of the keywords (e.g. __inline) are replaced by
+	the standard ones and __extension__ is dropped. The functions having
+	the code hidden by the placeholders are not macroized (see hides).
+	"""
+	def __init__(self):
+		self.texts = {} # placeholder -> text
+		self.kinds = {} # placeholder -> kind
+		self.names = {} # (kind, text) -> placeholder
+
+	def placeholder(self, kind, text):
+		if (kind, text) in self.names:
+			return self.names[(kind, text)]
+		name = rewrite.newname()
+		self.names[(kind, text)] = name
+		self.texts[name] = text
+		self.kinds[name] = kind
+		if kind in (PRE, POST, TYPE):
+			ext_pycparser.QUALIFIERS.add(name)
+		if kind in (TYPEOF, DECL):
+			ext_pycparser.TYPEDEFS.add(name)
+		return name
+
+	def shield(self, txt):
+		if not EXTENSIONS.search(txt):
+			return txt
+
+		toks = Tokens(txt)
+		out = list(toks.all)
+		before = {} # k -> text inserted before the k-th token
+		after = {} # k -> text inserted after the k-th token
+
+		def text(k0, k1):
+			return ''.join(toks.all[toks.sig[k0]:toks.sig[k1] + 1])
+
+		def replace(k0, k1, s):
+			"""
+			The tokens k0..k1 -> s. The lines are kept for the coords.
+			"""
+			for i in range(toks.sig[k0], toks.sig[k1] + 1):
+				out[i] = '\n' * out[i].count('\n')
+			out[toks.sig[k0]] = s + out[toks.sig[k0]]
+
+		def insert(table, k, s):
+			table[k] = table.get(k, '') + s
+
+		def end(k):
+			"""
+			The last token of the extension starting at the k-th token
+			"""
+			j = k + 1
+			if toks[k] in ASMS:
+				while toks[j] in ASM_QUALIFIERS:
+					j += 1
+			if toks[j] == "(" and j in toks.match:
+				return toks.match[j]
+			return k
+
+		def chainEnd(k):
+			"""
+			The token after the attributes and the asm labels from the k-th token
+			"""
+			while toks[k] in ATTRIBUTES or toks[k] in ASMS:
+				k = end(k) + 1
+			return k
+
+		k = 0
+		while k < len(toks):
+			tok = toks[k]
+			prev = toks[k - 1]
+			if tok == "__extension__":
+				replace(k, k, '')
+			elif tok in ALIASES:
+				out[toks.sig[k]] = ALIASES[tok]
+			elif tok in TYPES:
+				ext_pycparser.TYPEDEFS.add(tok)
+			elif tok in QUALIFIERS:
+				replace(k, k, self.placeholder(PRE, tok))
+			elif tok == "(" and toks[k + 1] == "{" and k in toks.match: # ({ ... })
+				e = toks.match[k]
+				replace(k, e, "%s()" % self.placeholder(EXPR, text(k, e)))
+				k = e
+			elif tok in BUILTINS and toks[k + 1] == "(":
+				e = end(k)
+				replace(k, e, "%s()" % self.placeholder(EXPR, text(k, e)))
+				k = e
+			elif tok in TYPEOFS and toks[k + 1] == "(":
+				e = end(k)
+				replace(k, e, self.placeholder(TYPEOF, text(k, e)))
+				k = e
+			elif tok in ASMS and end(k) != k:
+				e = end(k)
+				s = text(k, e)
+				if toks.depth[k] == 0 and (prev is None or prev in (";", "}") or prev.startswith("#")):
+					replace(k, e, "typedef int %s" % self.placeholder(DECL, s))
+				elif toks.boundary(k) or prev in ("else", "do") or \
+						(prev == ")" and toks[toks.match.get(k - 1, 0) - 1] in ("if", "while", "for", "switch")):
+					replace(k, e, "%s()" % self.placeholder(EXPR, s))
+				else: # The asm label
+					replace(k, e, '')
+					insert(before, toks.declStart(k), "%s " % self.placeholder(POST, s))
+				k = e
+			elif tok in ATTRIBUTES and end(k) != k:
+				e = end(k)
+				s = text(k, e)
+				following = toks[chainEnd(k)]
+				if prev in STRUCTS or (NAME.match(prev or "") and toks[k - 2] in STRUCTS):
+					body = e + 1 if toks[e + 1] == "{" else e + 2
+					if toks[body] == "{" and body in toks.match:
+						replace(k, e, '')
+						insert(after, toks.match[body], " %s" % self.placeholder(TYPE, s))
+					else: # Declared without the body
+						replace(k, e, '')
+						insert(before, k - 1 if prev in STRUCTS else k - 2, "%s " % self.placeholder(PRE, s))
+				elif prev == "}" and toks.structBody(toks.match.get(k - 1, 0)):
+					replace(k, e, self.placeholder(TYPE, s))
+				elif following == ";" and toks.boundary(k): # e.g. __attribute__((fallthrough));
+					replace(k, e, self.placeholder(STMT, s))
+				elif following in (";", ",", "=", ")", ":", "{"):
+					replace(k, e, '')
+					insert(before, toks.declStart(k), "%s " % self.placeholder(POST, s))
+				else:
+					replace(k, e, self.placeholder(PRE, s))
+				k = e
+			k += 1
+
+		for k, s in before.items():
+			out[toks.sig[k]] = s + out[toks.sig[k]]
+		for k, s in after.items():
+			out[toks.sig[k]] += s
+		return ''.join(out)
+
+	def restore(self, txt):
+		if not self.texts:
+			return txt
+
+		def decl(m):
+			if self.kinds.get(m.group(1)) == DECL:
+				return self.texts[m.group(1)]
+			return m.group(0)
+		txt = re.sub(r'\btypedef int (\w+)', decl, txt)
+
+		toks = Tokens(txt)
+		out = list(toks.all)
+		moved = {} # k -> [text] moved before the k-th token
+		for k in range(len(toks)):
+			name = toks[k]
+			kind = self.kinds.get(name)
+			if kind is None or kind == DECL:
+				continue
+			i = toks.sig[k]
+			out[i] = ''
+			if kind == EXPR and toks[k + 1] == "(" and toks[k + 2] == ")":
+				out[toks.sig[k + 1]] = ''
+				out[toks.sig[k + 2]] = ''
+			if kind in (POST, TYPE):
+				if i + 1 < len(out) and out[i + 1].isspace():
+					out[i + 1] = ''
+				j = self.position(toks, k, kind)
+				if j is not None:
+					moved.setdefault(j, []).append(self.texts[name])
+					continue
+			out[i] = self.texts[name]
+
+		for j, texts in moved.items():
+			i = toks.sig[j]
+			s = ' '.join(texts)
+			if not out[i - 1][-1:].isspace():
+				s = ' ' + s
+			if NAME.match(out[i]):
+				s += ' '
+			out[i] = s + out[i]
+		return ''.join(out)
+
+	def position(self, toks, k, kind):
+		"""
+		The token where the qualifier at the k-th token is moved back to.
+		The end of the declarator (POST) or the token after the struct
+		body (TYPE). None if not found.
+		"""
+		j = k + 1
+		while j < len(toks):
+			tok = toks[j]
+			if tok in ("(", "[", "{") and j in toks.match:
+				if tok == "{" and kind == TYPE:
+					return toks.match[j] + 1
+				j = toks.match[j] + 1
+				continue
+			if tok in (";", ",", "=", ":", ")", "]", "}"):
+				return j if kind == POST else None
+			j += 1
+		return None
+
+	def hides(self, n):
+		"""
+		The node has the code hidden by the placeholders.
+		"""
+		names = ext_pycparser.Result(ext_pycparser.AllNames()).visit(n)
+		return any(self.kinds.get(name) in (EXPR, TYPEOF) for name in names)
+
+t = Extensions()
+
+test_file = r"""
+# 1 "a.c"
+typedef struct __attribute__((packed)) S { char c; int x; } S;
+struct T { int a __attribute__((aligned(8))); } __attribute__((__may_alias__));
+extern int fscanf (FILE *__restrict __stream, const char *__restrict __format, ...) __asm__ ("" "__isoc99_fscanf") __attribute__ ((__nothrow__));
+__extension__ typedef long long int ll;
+static __inline __attribute__ ((__always_inline__)) unsigned int sw(unsigned int x) { return __builtin_bswap32(x); }
+__asm__(".symver f, f@VER_1");
+int g(int x __attribute__((unused)), int y)
+{
+	__typeof__(y) z = ({ int w = y; w * 2; });
+	switch (z) {
+	case 1:
+		__attribute__((fallthrough));
+	default:
+		__asm__ __volatile__ ("" : : : "memory");
+	}
+	return z;
+}
+"""
+
+if __name__ == "__main__":
+	ext_pycparser.TYPEDEFS.add("FILE")
+	txt = t.shield(test_file)
+	print txt
+	ast = ext_pycparser.ast_of(txt)
+	print t.restore(ext_pycparser.CGenerator().visit(ast))
@@ -0,0 +1,299 @@
+from pycparser import c_ast
+
+import compound
+import ext_pycparser
+import rewrite
+import rewrite_non_void
+
+class HoistableCalls(ext_pycparser.NodeVisitor):
+	"""
+	Slots of the calls in an expression that can be evaluated before the
+	statement, in the order to be evaluated (arguments first).
+
+	The operands that may not be evaluated (the right side of && and ||,
+	the branches of ?: and sizeof) and the operands after a comma are
+	not gone down.
+	"""
+	def __init__(self, hoistable, top):
+		self.hoistable = hoistable # name -> bool
+		self.top = top # The call left to the later stages (e.g. r = f(x))
+		self.result = []
+
+	def leave_FuncCall(self, n):
+		if n is self.top or self.current_slot is None:
+			return
+		if self.hoistable(rewrite.FuncCallName(n)):
+			self.result.append(self.current_slot)
+
+	def visit_BinaryOp(self, n):
+		if n.op in ("&&", "||"):
+			self.visit(n.left)
+		else:
+			self.generic_visit(n)
+
+	def visit_TernaryOp(self, n):
+		self.visit(n.cond)
+
+	def visit_ExprList(self, n):
+		if isinstance(self.current_slot.owner, c_ast.FuncCall): # Arguments
+			self.generic_visit(n)
+		elif n.exprs: # Comma operator
+			self.visit(n.exprs[0])
+
+	def visit_UnaryOp(self, n):
+		if n.op != "sizeof":
+			self.generic_visit(n)
+
+class ContinueToGoto(ext_pycparser.NodeVisitor):
+	"""
+	continue; -> goto label;
+	The continues of the inner loops are left.
+	"""
+	def __init__(self, label):
+		self.label = label
+
+	def visit_Continue(self, n):
+		self.current_slot.replace(c_ast.Goto(self.label))
+
+	def visit_For(self, n):
+		pass
+
+	def visit_While(self, n):
+		pass
+
+	def visit_DoWhile(self, n):
+		pass
+
+# Statements evaluated as a whole
+EXPRESSIONS = (c_ast.Assignment, c_ast.FuncCall, c_ast.Cast, c_ast.UnaryOp, c_ast.BinaryOp,
+               c_ast.TernaryOp, c_ast.ExprList, c_ast.ArrayRef, c_ast.StructRef)
+
+def topCall(item):
+	"""
+	The call that the later stages take as it is.
+
+	f(x);
+	(void) f(x);
+	r = f(x);
+	return f(x);
+	"""
+	if isinstance(item, c_ast.FuncCall):
+		return item
+	if isinstance(item, (c_ast.Cast, c_ast.Return)) and isinstance(item.expr, c_ast.FuncCall):
+		return item.expr
+	if isinstance(item, c_ast.Assignment) and item.op == "=" and isinstance(item.rvalue, c_ast.FuncCall):
+		return item.rvalue
+	return None
+
+def splittable(decl):
+	"""
+	T x = e; -> T x; x = e;
+	const T x = e; -> T t; t = e; const T x = t;
+
+	Not for the arrays, the initializer lists, the static variables
+	and the types made const by typedef.
+	"""
+	if decl.init is None or isinstance(decl.init, c_ast.InitList):
+		return False
+	if set(decl.storage) - set(["auto", "register"]):
+		return False
+	ty = decl.type
+	if not isinstance(ty, (c_ast.TypeDecl, c_ast.PtrDecl)):
+		return False
+	while isinstance(ty, c_ast.TypeDecl) and isinstance(ty.type, c_ast.IdentifierType) \
+			and ty.type.names[-1] in rewrite.t.typedefs:
+		ty = rewrite.t.typedefs[ty.type.names[-1]].type
+		if not isinstance(ty, (c_ast.TypeDecl, c_ast.PtrDecl)) or "const" in ty.quals:
+			return False
+	return True
+
+def isConst(decl):
+	"""
+	const T x, T *const p
+	"""
+	return isinstance(decl.type, (c_ast.TypeDecl, c_ast.PtrDecl)) and "const" in decl.type.quals
+
+def mkTmpDecl(decl, name):
+	"""
+	const T x = e;, name -> T name;
+	"""
+	ty = ext_pycparser.unconst(ext_pycparser.copy_ast(decl.type))
+	ext_pycparser.RewriteTypeDecl(name).visit(ty)
+	return c_ast.Decl(name, [q for q in decl.quals if q != "const"], [], [], ty, None, None)
+
+class Hoist(compound.NodeVisitor, compound.SymbolTableMixin):
+	"""
+	if (f(x)) ...     -> T t; t = f(x); if (t) ...
+	return a + f(x);  -> T t; t = f(x); return a + t;
+	y = g(f(x)) * 2;  -> T t; t = f(x); y = g(t) * 2;
+
+	Pulls the calls to the macroizables out of the expressions so they
+	are taken as r = f(x) by the later stages.
+
+	The declarations having such calls in the initializers are split.
+	The declarations after them are split too so the initializers are
+	evaluated in the same order after all the declarations (C90):
+
+	int a = 0; int b = f(a); int c = b; -> int a = 0; int b; int c; b = f(a); c = b;
+
+	A declaration that can't be split (e.g. int v[] = {b}) and the rest
+	of the compound go into a new compound after the assignments.
+	A const variable is initialized there by a temporary split instead:
+
+	const int b = f(a); int c = b; -> int t; t = f(a); { const int b = t; int c = b; }
+
+	The loop headers having such calls are moved into the statements:
+
+	for (init; cond; next) body -> init; for (;;) { if (!(cond)) break; body; L: ; next; }
+	while (cond) body           -> while (1) { if (!(cond)) break; body }
+	do body while (cond)        -> do { body; L: ; if (!(cond)) break; } while (1)
+
+	where the continues of the loop are rewritten to goto L.
+
+	result is the hoistable calls. They are hoisted only if apply is True.
+	"""
+	def __init__(self, func, macroizables, apply=False):
+		compound.SymbolTableMixin.__init__(self, func, macroizables)
+		self.apply = apply
+		self.result = []
+
+	def hoistable(self, name):
+		if not self.canMacroize(name):
+			return False
+		_, func = rewrite.t.all_funcs[name]
+		return not ext_pycparser.FuncDef(func).returnVoid()
+
+	def visit_Compound(self, n):
+		self.switch()
+		self.splitDecls(n)
+
+		for i, item in enumerate(n.block_items or []):
+			if isinstance(item, c_ast.Decl):
+				self.register(item)
+				continue
+
+			slot = ext_pycparser.Slot(n, "block_items", i)
+			if isinstance(item, (c_ast.For, c_ast.While, c_ast.DoWhile)):
+				self.restructureLoop(slot, item)
+				continue
+			elif isinstance(item, (c_ast.If, c_ast.Switch)):
+				root = ext_pycparser.Slot(item, "cond")
+			elif isinstance(item, c_ast.Return) and item.expr:
+				root = ext_pycparser.Slot(item, "expr")
+			elif isinstance(item, EXPRESSIONS):
+				root = slot
+			else:
+				continue
+
+			calls = HoistableCalls(self.hoistable, topCall(item))
+			calls.walk(root.get(), root)
+			self.result.extend([call_slot.get() for call_slot in calls.result])
+			if self.apply:
+				for call_slot in calls.result:
+					self.hoist(slot, call_slot)
+
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
+		self.revert()
+
+	def movedCalls(self, owner, attr, top):
+		"""
+		([Slot], [FuncCall])
+
+		The hoistable calls in owner.attr and all the calls to macroize
+		if the expression is moved out to a statement where top is
+		taken by the later stages. Nothing if no call.
+		"""
+		calls = HoistableCalls(self.hoistable, top)
+		calls.walk(getattr(owner, attr), ext_pycparser.Slot(owner, attr))
+		result = [call_slot.get() for call_slot in calls.result]
+		if top is not None and self.canMacroize(rewrite.FuncCallName(top)):
+			result.append(top)
+		return calls.result, result
+
+	def splitDecls(self, n):
+		items = n.block_items or []
+		result = []
+		assigns = [] # The initializers split from the current declarations
+		for i, item in enumerate(items):
+			if not isinstance(item, (c_ast.Decl, c_ast.Typedef)):
+				result.extend(assigns)
+				assigns = []
+				result.append(item)
+				continue
+
+			split = False
+			if isinstance(item, c_ast.Decl) and item.init is not None:
+				top = item.init if isinstance(item.init, c_ast.FuncCall) else None
+				_, calls = self.movedCalls(item, "init", top)
+				if splittable(item) and (assigns or calls):
+					self.result.extend(calls)
+					if not isConst(item):
+						split = True
+						assigns.append(c_ast.Assignment("=", c_ast.ID(item.name), item.init))
+						if self.apply:
+							item.init = None
+					elif self.apply: # Can't be assigned. Initialized by the temporary.
+						tmp = rewrite.newname()
+						result.append(mkTmpDecl(item, tmp))
+						assigns.append(c_ast.Assignment("=", c_ast.ID(tmp), item.init))
+						item.init = c_ast.ID(tmp)
+			if not split and assigns:
+				# After the split ones. Initialized or typed (int a[n]) by their values.
+				if self.apply:
+					n.block_items = result + assigns + [c_ast.Compound(items[i:])]
+					return
+				assigns = []
+			if isinstance(item, c_ast.Decl):
+				self.register(item)
+			result.append(item)
+
+		if self.apply and n.block_items:
+			n.block_items = result + assigns
+
+	def restructureLoop(self, slot, loop):
+		moved = {} # attr -> [Slot] of the hoistable calls
+		for attr in (["init", "cond", "next"] if isinstance(loop, c_ast.For) else ["cond"]):
+			expr = getattr(loop, attr)
+			if expr is None or isinstance(expr, c_ast.DeclList): # for (int i = 0; ...) isn't moved
+				continue
+			top = topCall(expr) if attr != "cond" else None # cond is moved into if (!(cond))
+			hoistables, calls = self.movedCalls(loop, attr, top)
+			if calls:
+				moved[attr] = hoistables
+				self.result.extend(calls)
+
+		if not self.apply or not moved:
+			return
+
+		body = loop.stmt
+		head = []
+		tail = []
+		if "init" in moved: # Evaluated once before the loop
+			for call_slot in moved["init"]:
+				self.hoist(slot, call_slot)
+			self.insertBefore(slot, loop.init)
+			loop.init = None
+		if "cond" in moved:
+			head.append(c_ast.If(c_ast.UnaryOp("!", loop.cond), c_ast.Break(), None))
+			loop.cond = None if isinstance(loop, c_ast.For) else c_ast.Constant("int", "1")
+		if "next" in moved:
+			tail.append(loop.next)
+			loop.next = None
+		if isinstance(loop, c_ast.DoWhile): # The condition is after the body
+			head, tail = [], tail + head
+		if tail: # continue goes to the rest of the iteration
+			label = rewrite.newname()
+			ContinueToGoto(label).visit(body)
+			tail.insert(0, c_ast.Label(label, c_ast.EmptyStatement()))
+		loop.stmt = c_ast.Compound(head + [body] + tail)
+		compound.Brace().visit(loop.stmt)
+
+	def hoist(self, slot, call_slot):
+		call = call_slot.get()
+		_, func = rewrite.t.all_funcs[rewrite.FuncCallName(call)]
+		tmp = rewrite.newname()
+		self.insertFirst(slot, rewrite_non_void.mkDecl(func, tmp))
+		self.insertBefore(slot, c_ast.Assignment("=", c_ast.ID(tmp), call))
+		call_slot.replace(c_ast.ID(tmp))
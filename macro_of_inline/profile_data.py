@@ -0,0 +1,105 @@
+import json
+import os
+import re
+import subprocess
+import zlib
+
+class Record:
+	def __init__(self, name, count, filename=None):
+		self.name = name
+		self.count = count
+		self.filename = filename # None if the format doesn't tell
+
+def gcov_json(txt):
+	"""
+	gcov --json-format (gcc 9 or later)
+	Each line is a JSON document if printed with --stdout.
+	"""
+	result = []
+	for line in txt.splitlines():
+		if not line.startswith("{"):
+			continue
+		for f in json.loads(line).get("files", []):
+			for func in f.get("functions", []):
+				result.append(Record(func["name"], func["execution_count"], f.get("file")))
+	return result
+
+def gcov_intermediate(txt):
+	"""
+	gcov -i (before gcc 9)
+
+	file:a.c
+	function:1,1,500,sq (gcc 8)
+	function:1,500,sq (older)
+	"""
+	result = []
+	filename = None
+	for line in txt.splitlines():
+		if line.startswith("file:"):
+			filename = line[len("file:"):]
+		elif line.startswith("function:"):
+			fields = line[len("function:"):].split(",")
+			result.append(Record(fields[-1], int(fields[-2]), filename))
+	return result
+
+# Flat profile
+#  %   cumulative   self              self     total
+# time   seconds   seconds    calls  ms/call  ms/call  name
+# 60.00      0.03     0.03      500     0.06     0.06  sq
+GPROF_FLAT = re.compile(r'^\s*[\d.]+\s+[\d.]+\s+[\d.]+\s+(\d+)\s+[\d.]+\s+[\d.]+\s+(\S+)\s*$')
+
+# Primary lines of the call graph (called is n+m for recursive calls)
+# index % time    self  children    called     name
+# [1]      0.0    0.00    0.00     500         sq [1]
+GPROF_GRAPH = re.compile(r'^\[\d+\]\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+(\d+)(?:\+\d+)?\s+(\S+)(?: <cycle \d+>)?\s+\[\d+\]\s*$')
+
+def gprof(txt):
+	result = []
+	for line in txt.splitlines():
+		m = GPROF_FLAT.match(line) or GPROF_GRAPH.match(line)
+		if m:
+			result.append(Record(m.group(2), int(m.group(1))))
+	return result
+
+def records(filename):
+	"""
+	Filename -> [Record]
+
+	The format is told from the contents. .gcda is converted by gcov.
+	"""
+	if filename.endswith(".gcda"):
+		txt = subprocess.check_output(["gcov", "--json-format", "--stdout", filename])
+		return gcov_json(txt)
+
+	with open(filename, "rb") as fp:
+		txt = fp.read()
+	if txt.startswith("\x1f\x8b"): # gcov -j writes .gcov.json.gz
+		txt = zlib.decompress(txt, 16 + zlib.MAX_WBITS)
+
+	if txt.lstrip().startswith("{"):
+		return gcov_json(txt)
+	if re.search(r'^function:', txt, re.M):
+		return gcov_intermediate(txt)
+	return gprof(txt)
+
+def call_counts(filename, source=None):
+	"""
+	Filename -> {name: count}
+
+	Static functions of the same name in other files are not counted
+	if the profile tells the file of the functions.
+	"""
+	rs = records(filename)
+	if source:
+		base = os.path.basename(source)
+		mine = [r for r in rs if r.filename and os.path.basename(r.filename) == base]
+		if mine:
+			rs = mine
+	result = {}
+	for r in rs:
+		result[r.name] = max(result.get(r.name, 0), r.count) # gprof lists a function in both the flat profile and the call graph
+	return result
+
+if __name__ == "__main__":
+	print gcov_intermediate("file:a.c\nfunction:1,1,500,sq\nfunction:2,1,cold\n")[0].count
+	print [(r.name, r.count) for r in gprof("  0.00      0.00     0.00      500     0.00     0.00  sq\n[2]      0.0    0.00    0.00       1+2       cold [2]\n")]
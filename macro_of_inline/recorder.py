@@ -29,9 +29,16 @@ class Recorder:
 		return str(ela * 1000) + "[ms]"
 
 	def file_record(self, title, contents):
+		"""
+		@contents Text or AST.
+		AST is generated into text only if recording is enabled.
+		"""
 		if not cfg.t.record_enabled:
 			return
 
+		if not isinstance(contents, basestring):
+			contents = ext_pycparser.CGenerator().visit(contents)
+
 		self.file_rewrite_level += 1
 		fn = "%s/%d-%s.c" % (self.rec_dir, self.file_rewrite_level, title)
 		f = open(fn, "w")
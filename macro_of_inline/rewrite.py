@@ -1,16 +1,25 @@
 from pycparser import c_ast
 
+import cache
 import cfg
 import copy
 import compound
 import cppwrap
+import devirtualize
 import ext_pycparser
+import gnu
+import hoist
 import os
+import profile_data
 import pycparser
+import re
 import recorder
+import rewrite_expr
 import rewrite_void
 import rewrite_non_void
 import sys
+import tailcall
+import unroll
 import utils
 
 class FuncDef(ext_pycparser.FuncDef):
@@ -26,7 +35,7 @@ class FuncDef(ext_pycparser.FuncDef):
 			return 4
 		return 0
 
-	class IsRecursive(c_ast.NodeVisitor, compound.SymbolTableMixin):
+	class IsRecursive(ext_pycparser.NodeVisitor, compound.SymbolTableMixin):
 		def __init__(self, func):
 			compound.SymbolTableMixin.__init__(self, func, set())
 			self.result = False
@@ -36,7 +45,9 @@ class FuncDef(ext_pycparser.FuncDef):
 
 		def visit_Compound(self, n):
 			self.switch()
-			c_ast.NodeVisitor.generic_visit(self, n)
+			self.generic_visit(n)
+
+		def leave_Compound(self, n):
 			self.revert()
 
 		def visit_FuncCall(self, n):
@@ -49,14 +60,33 @@ class FuncDef(ext_pycparser.FuncDef):
 				self.result = True
 
 	def isRecursive(self):
-		return ext_pycparser.Result(self.IsRecursive(self.func)).visit(self.func)
+		# Not from the FuncDef. Its Decl would hide the name of itself.
+		return ext_pycparser.Result(self.IsRecursive(self.func)).visit(self.func.body)
 
 	def doMacroize(self):
 		if self.hasVarArgs():
 			return False
 		# Recursive call can't be macroized in any safe ways.
+		# (The tail calls are made loops. --unroll-recursion macroizes the copies of the first levels)
 		if self.isRecursive():
 			return False
+		# The code in the placeholders can't be rewritten.
+		if gnu.t.hides(self.func):
+			return False
+		# Chosen with the original (see unroll)
+		if self.name() in t.copies:
+			return True
+		return self.chosen()
+
+	def chosen(self):
+		"""
+		Chosen by the profile or the inline mask
+		"""
+		if t.calls is not None:
+			# Only the hot ones. Hot static functions are macroized even if not inline.
+			if t.calls.get(self.name(), 0) < cfg.t.profile_threshold:
+				return False
+			return bool(self.inline_bit() & (cfg.t.inline_mask | 4))
 
 		if self.inline_bit() & cfg.t.inline_mask:
 			return True
@@ -73,7 +103,7 @@ def FuncCallName(n):
 	but in pratice it is useless because most of the function calls are
 	in basic pattern (use the name as it defines).
 
-	We give random BLACKNAME that doesn't appear as function name
+	We give BLACKNAME that can't appear as function name
 	to exclude the complex call patterns.
 	"""
 	if isinstance(n.name, c_ast.ID):
@@ -83,47 +113,100 @@ def FuncCallName(n):
 
 class Context:
 	def __init__(self):
-		self.rand_names = set()
+		self.names = utils.NameGen(cfg.t.name_prefix, cfg.t.name_seed)
 
 		self.all_funcs = {} # name -> (i, ast)
 		self.macroizables = set() # set(name)
+		self.expressions = {} # name -> rewrite_expr.Expression
 		self.typedefs = {} # name -> ast
-
-	def blacklist(self, ast):
-		f = lambda n: FuncCallName(n)
-		all_calls = utils.countMap(map(f, ext_pycparser.Result(ext_pycparser.AllFuncCalls()).visit(ast)))
-		# print all_calls
-		incomp_calls = utils.countMap(map(f, ext_pycparser.Result(compound.AllFuncCalls()).visit(ast)))
-		# print incomp_calls
-		utils.countMapDiff(all_calls, incomp_calls)
-		return set([k for k, v in all_calls.items() if v > 0])
-
-	def setupAST(self, ast):
-		compound.Brace().visit(ast) # The statements always be surrounded by { and }
-
+		self.deps = [] # files read to translate the TU
+		self.calls = None # name -> count in the profile. None without the profile
+		self.unrolled = {} # name -> [name of the copy]
+		self.copies = {} # name of the copy -> name
+
+	def blacklist(self, ast, hoistable):
+		"""
+		The functions called inside expressions except the calls hoistable
+		"""
+		compatible = set([id(n) for n in ext_pycparser.Result(compound.AllFuncCalls()).visit(ast)])
+		compatible.update([id(n) for n in hoistable])
+		all_calls = ext_pycparser.Result(ext_pycparser.AllFuncCalls()).visit(ast)
+		return set([FuncCallName(n) for n in all_calls if id(n) not in compatible])
+
+	def scan(self, ast):
 		for i, n in enumerate(ast.ext):
 			if isinstance(n, c_ast.FuncDef):
 				self.all_funcs[FuncDef(n).name()] = (i, n)
 			if isinstance(n, c_ast.Typedef):
 				self.typedefs[n.name] = n
+			if isinstance(n, ext_pycparser.Aside):
+				for m in n.nodes:
+					if isinstance(m, c_ast.Typedef):
+						self.typedefs[m.name] = m
+
+	def refresh(self, ast):
+		"""
+		The names and the functions of the AST rewritten (e.g. void_f added)
+		"""
+		self.names.reserve(ext_pycparser.Result(ext_pycparser.AllNames()).visit(ast))
+		self.scan(ast)
 
+	def setupAST(self, ast):
+		"""
+		Once for the translation (AST). The rewrites after it only refresh().
+		"""
+		compound.Brace().visit(ast) # The statements always be surrounded by { and }
+
+		self.refresh(ast)
+
+		if DEVIRTUALIZE: # The calls found can be recursive
+			devirtualize.Main(ast).run()
+
+		if LOOP_TAIL_CALLS: # Before they are found recursive
+			tailcall.Main(ast).run()
+
+		if cfg.t.unroll_recursion > 0:
+			unroll.Main(ast, cfg.t.unroll_recursion).run()
+			self.scan(ast) # The copies are inserted
+
+		candidates = set()
 		for name, (_, n) in self.all_funcs.items():
 			if not FuncDef(n).doMacroize():
 				continue
-			self.macroizables.add(name)
+			candidates.add(name)
+
+		if MACROIZE_EXPRESSION: # Before their calls are hoisted
+			rewrite_expr.Main(ast, candidates).run()
+
+		if cfg.t.dialect == "gnu": # The macros are expressions. They can be called anywhere.
+			self.macroizables |= candidates
+			return
+
+		hoistable = []
+		for (_, n) in self.all_funcs.values():
+			hoistable.extend(ext_pycparser.Result(hoist.Hoist(n, candidates)).visit(n))
 
 		# Exclude functions calls inside expressions
-		blacklist = self.blacklist(ast)
+		blacklist = self.blacklist(ast, hoistable)
 		# print blacklist
+		self.macroizables |= candidates
 		self.macroizables -= blacklist
 
+		for (_, n) in sorted(self.all_funcs.values()):
+			hoist.Hoist(n, self.macroizables, apply=True).visit(n)
+
 t = Context()
 
-def newrandstr():
-	return utils.newrandstr(t.rand_names, utils.N)
-BLACKNAME = newrandstr()
+def newname():
+	return t.names.new()
+
+# Not an identifier
+BLACKNAME = "<blackname>"
 
 MACROIZE_NON_VOID = True
+MACROIZE_EXPRESSION = True
+DEVIRTUALIZE = True
+LOOP_TAIL_CALLS = True
 class AST:
 	"""
 	AST -> AST
@@ -133,11 +216,12 @@ class AST:
 		self.ast = ast
 
 	def run(self):
-		if MACROIZE_NON_VOID:
+		# The statement expressions return the values by themselves.
+		if MACROIZE_NON_VOID and cfg.t.dialect != "gnu":
 			runner = rewrite_non_void.Main(self.ast)
 			runner.run()
 			self.ast = runner.returnAST()
-			recorder.t.file_record("convert_non_void_to_void", ext_pycparser.CGenerator().visit(self.ast))
+			recorder.t.file_record("convert_non_void_to_void", self.ast)
 
 		runner = rewrite_void.Main(self.ast)
 		runner.run()
@@ -147,41 +231,169 @@ class AST:
 	def returnAST(self):
 		return self.ast
 
-class Wrap:
+def isolateHeaders(ast, main):
 	"""
-	Text -> AST
+	Set the top-level nodes from the headers aside (ext_pycparser.Aside)
+	so that the rewrites don't visit them. Most of the TU is the declarations
+	from the headers that never need rewriting. The functions defined in the
+	headers are kept if they are referred from the main file because they
+	may be macroized.
+
+	Consecutive nodes are put in one Aside to keep the order of the nodes.
 	"""
-	def __init__(self, txt):
-		self.txt = txt
+	def fromHeader(n):
+		fn = ext_pycparser.origin(n)
+		return fn and fn != main
+
+	header_funcs = {}
+	for n in ast.ext:
+		if fromHeader(n) and isinstance(n, c_ast.FuncDef):
+			header_funcs[FuncDef(n).name()] = n
+
+	# Functions referred from the main file directly or indirectly
+	kept = set()
+	names = ext_pycparser.AllNames()
+	for n in ast.ext:
+		if not fromHeader(n):
+			names.visit(n)
+	todo = list(names.result)
+	while todo:
+		name = todo.pop()
+		if name in kept or not name in header_funcs:
+			continue
+		kept.add(name)
+		todo.extend(ext_pycparser.Result(ext_pycparser.AllNames()).visit(header_funcs[name]))
+
+	ext = []
+	for n in ast.ext:
+		if fromHeader(n) and not (isinstance(n, c_ast.FuncDef) and FuncDef(n).name() in kept):
+			if ext and isinstance(ext[-1], ext_pycparser.Aside):
+				ext[-1].nodes.append(n)
+			else:
+				ext.append(ext_pycparser.Aside([n], n.coord))
+		else:
+			ext.append(n)
+	ast.ext = ext
 
-	def run(self):
-		fake_include = cfg.t.fake_include
+class NoCandidate(Exception):
+	"""
+	No function in the TU can be macroized.
+	"""
+	pass
 
-		if fake_include:
-			fn = "/tmp/%s.c" % utils.randstr(16)
-			with open(fn, "w") as fp:
-				fp.write(self.txt)
+STATIC = r'\bstatic\b'
 
-			# TODO Ugly. Loan pattern
-			try:
-				cpp_args = ['-E', r'-include%s' % fake_include]
-				cpped_txt = utils.preprocess_file(fn, cpp_path='gcc', cpp_args=cpp_args)
-			except Exception as e:
-				sys.stderr.write(e.message)
-				sys.exit(1)
-			finally:
-				os.remove(fn)
-		else:
-			cpped_txt = self.txt
+def inline_pattern():
+	"""
+	inline and the spellings gnu.shield() makes inline.
+	Not at the import because gnu imports this module.
+	"""
+	return r'\b(?:%s)\b' % '|'.join(["inline"] + sorted([k for k, v in gnu.ALIASES.items() if v == "inline"]))
+
+def definition_pattern():
+	"""
+	The head of a function definition: specifiers ... name(params) {
+	"""
+	return re.compile(r'(?:%s|%s)[^;{}]*\)\s*\{' % (inline_pattern(), STATIC))
+
+def split_lines(txt, main):
+	"""
+	Text -> (text of the main file, text of the others)
+
+	Told by the line markers. All the text is of the main file without them.
+	"""
+	ours = []
+	others = []
+	current = main
+	for line in txt.splitlines():
+		if line.startswith("#"):
+			m = utils.LINEMARKER.match(line)
+			if m:
+				current = m.group(1).replace('\\\\', '\\')
+				continue
+		(others if main and current != main else ours).append(line)
+	return '\n'.join(ours), '\n'.join(others)
+
+def inline_bits(head):
+	hasInline = re.search(inline_pattern(), head) is not None
+	hasStatic = re.search(STATIC, head) is not None
+	return (1 if hasInline and hasStatic else 0) | (2 if hasInline else 0) | (4 if hasStatic else 0)
+
+def hasCandidates(txt, main=None):
+	"""
+	Token-level check before parsing.
+	False if no function definition can match cfg.t.inline_mask.
 
-		ast = AST(ext_pycparser.ast_of(cpped_txt)).run().returnAST()
+	Only the main file is scanned. The headers nearly always have static
+	or inline. Their functions count only if defined as such (inline,
+	__inline__, static) and referred from the main file (see isolateHeaders).
+	"""
+	mask = cfg.t.inline_mask
+	if cfg.t.profile_data:
+		mask |= 4
+	ours, others = split_lines(txt, main)
+	if mask & inline_bits(ours):
+		return True
+	names = set(re.findall(r'\w+', ours))
+	for m in definition_pattern().finditer(others):
+		# Any name followed by ( can be of the function
+		head = m.group(0)
+		if names.intersection(re.findall(r'(\w+)\s*\(', head)) and mask & inline_bits(head):
+			return True
+	return False
 
-		if fake_include:
-			with open(fake_include) as fp:
-				ast_b = ext_pycparser.ast_of(fp.read())
-			cppwrap.ast_delete(ast, ast_b)
+FAKE_TYPEDEFS = os.path.join(os.path.dirname(__file__), 'fake_libc_include', '_fake_typedefs.h')
 
-		return ast
+class Wrap:
+	"""
+	Text -> AST
+	"""
+	def __init__(self, txt):
+		self.txt = txt
+
+	def run(self):
+		# The parser knows the fake typedefs in advance. We don't need to
+		# preprocess the text with them included and drop them after all.
+		fake_files = []
+		if cfg.t.fake_typedefs:
+			fake_files.append(FAKE_TYPEDEFS)
+		if cfg.t.fake_include:
+			fake_files.append(cfg.t.fake_include)
+		for fn in fake_files:
+			with open(fn) as fp:
+				ext_pycparser.TYPEDEFS.update(ext_pycparser.typedef_names(fp.read()))
+			t.deps.append(fn)
+
+		# The main file is where the preprocessing started.
+		main = utils.included_files(self.txt)[:1]
+
+		if cfg.t.profile_data:
+			t.calls = profile_data.call_counts(cfg.t.profile_data, main[0] if main else None)
+			t.deps.append(cfg.t.profile_data)
+
+		cpped_txt = self.txt
+		if not hasCandidates(cpped_txt, main[0] if main else None):
+			raise NoCandidate()
+
+		# Cheaper than collecting the names from the AST.
+		t.names.reserve([cpped_txt])
+
+		# The placeholders are generated names.
+		cpped_txt = gnu.t.shield(cpped_txt)
+
+		def prepare(ast):
+			if main:
+				isolateHeaders(ast, main[0])
+			compound.Brace().visit(ast)
+			return ast
+
+		# Parsed, isolated and normalized AST only depends on the text.
+		ast = cache.t.ast_of(cpped_txt, prepare, "prepared")
+
+		runner = AST(ast)
+		if not t.macroizables and not t.expressions:
+			raise NoCandidate()
+		return runner.run().returnAST()
 
 class Main:
 	"""
@@ -189,29 +401,91 @@ class Main:
 	"""
 	def __init__(self, filename):
 		self.filename = filename
+		self.skipped = False
 
 	def run(self):
+		"""
+		The file without any function to macroize is left as it is.
+		"""
+		try:
+			return self.translate()
+		except NoCandidate:
+			self.skipped = True
+			with open(self.filename, "r") as fp:
+				return fp.read()
+
+	def translate(self):
 		f = lambda text: Wrap(text).run() # Text -> AST
 		if cfg.t.with_cpp:
 			if cfg.t.cpp_mode == 'gcc':
 				cpped_txt = utils.cpp(self.filename)
+				t.deps.extend(utils.included_files(cpped_txt))
 				output = ext_pycparser.CGenerator().visit(f(cpped_txt))
 			else:
-				output = cppwrap.Apply(f).on(self.filename)
+				applier = cppwrap.Apply(f)
+				try:
+					output = applier.on(self.filename)
+				finally:
+					t.deps.extend(applier.deps)
 		else:
 			with open(self.filename, "r") as fp:
 				cpped_txt = fp.read()
 			try:
 				output = ext_pycparser.CGenerator().visit(f(cpped_txt))
+			except NoCandidate:
+				raise
 			except:
 				sys.stderr.write("[ERROR] %s failed to parse. Is this file preprocessed? Do you forget --with-cpp?\n" % self.filename)
 				sys.exit(1)
-		return ext_pycparser.CGenerator.cleanUp(output)
+		return gnu.t.restore(ext_pycparser.CGenerator.cleanUp(output))
+
+	def dependencies(self):
+		"""
+		All the files the output depends on: the input, the headers,
+		the fake include and this program itself.
+		"""
+		deps = []
+		for fn in [self.filename] + t.deps + utils.tool_files():
+			fn = os.path.normpath(fn)
+			if not fn in deps:
+				deps.append(fn)
+		return deps
 
 if __name__ == "__main__":
 	fn = "/tmp/%s.c" % utils.randstr(16)
 	with open(fn, "w") as fp:
 		fp.write(utils.cpp("tests/proj/main.c"))
-	output = Main(fn).run()
+	import rewrite # This file is loaded twice when run as a script. The others see this one.
+	output = rewrite.Main(fn).run()
 	print output
 	os.remove(fn)
+
+	# Deeper than the Python stack: a long else-if chain and a long expression.
+	N = 1000
+	code = """
+static inline int classify(int x)
+{
+	int r;
+	if (x == 0) r = 0;
+%s
+	else r = -1;
+	return r;
+}
+static inline int sum(int x) { return %s; }
+int main(void)
+{
+	int r = classify(%d);
+	r += sum(1);
+	return r;
+}
+""" % ("\n".join(["\telse if (x == %d) r = %d;" % (i, i % 7) for i in range(1, N)]),
+       " + ".join(["x * %d" % (i % 3) for i in range(N)]), N - 1)
+	with open(fn, "w") as fp:
+		fp.write(code)
+	rewrite.t = rewrite.Context() # A new translation
+	cfg.t.function_growth = cfg.t.unit_growth = float(N) # main is small. Let them expand.
+	output = rewrite.Main(fn).run()
+	main = output[output.rindex("int main(void)"):]
+	assert "classify(" not in main and "sum(" not in main
+	print "%d branches, %d terms: %d lines" % (N, N, len(output.splitlines()))
+	os.remove(fn)
@@ -0,0 +1,312 @@
+from pycparser import c_ast
+
+import compound
+import ext_pycparser
+import recorder
+import rewrite
+
+class Effects(ext_pycparser.NodeVisitor):
+	"""
+	What an expression does when the expression macros in it are expanded.
+
+	pure: No side effect (assignment, ++, --, the calls not expanded)
+	      and no &x of the params (&((int) (arg)) is not an lvalue).
+	closed: Reads nothing but the params. No other names, no memory through pointers.
+	count: param -> times evaluated
+	cond: The params evaluated only under a condition (&&, ||, ?:) or not at all (sizeof).
+	free: The names other than the params the expression refers to.
+	braces: Has { } that the preprocessor doesn't take as a part of a macro argument.
+	"""
+	def __init__(self, params, expandable):
+		self.params = params
+		self.expandable = expandable # FuncCall -> Expression or None
+		self.pure = True
+		self.closed = True
+		self.count = dict((p, 0) for p in params)
+		self.cond = set()
+		self.free = set()
+		self.braces = False
+
+		# The context of the current node: (times, conditional, address)
+		self.context = (1, False, False)
+
+	def under(self, slot, times=1, conditional=False, address=False):
+		saved = self.context
+		self.context = (saved[0] * times, saved[1] or conditional, saved[2] or address)
+		self.visit(slot.get())
+		self.context = saved
+
+	def visit_ID(self, n):
+		if n.name in self.count:
+			times, conditional, address = self.context
+			self.count[n.name] += times
+			if conditional:
+				self.cond.add(n.name)
+			if address:
+				self.pure = False
+		else:
+			self.closed = False
+			self.free.add(n.name)
+
+	def visit_IdentifierType(self, n):
+		for name in n.names:
+			if name in rewrite.t.typedefs:
+				self.free.add(name)
+
+	def visit_Assignment(self, n):
+		self.pure = False
+		self.generic_visit(n)
+
+	def visit_UnaryOp(self, n):
+		if n.op in ("++", "--", "p++", "p--"):
+			self.pure = False
+		if n.op == "*":
+			self.closed = False
+		if n.op == "sizeof": # Not evaluated
+			self.under(ext_pycparser.Slot(n, "expr"), times=0, conditional=True)
+		elif n.op == "&":
+			self.under(ext_pycparser.Slot(n, "expr"), address=True)
+		else:
+			self.generic_visit(n)
+
+	def visit_BinaryOp(self, n):
+		self.under(ext_pycparser.Slot(n, "left"))
+		self.under(ext_pycparser.Slot(n, "right"), conditional=n.op in ("&&", "||"))
+
+	def visit_TernaryOp(self, n):
+		self.under(ext_pycparser.Slot(n, "cond"))
+		self.under(ext_pycparser.Slot(n, "iftrue"), conditional=True)
+		self.under(ext_pycparser.Slot(n, "iffalse"), conditional=True)
+
+	def visit_StructRef(self, n):
+		if n.type == "->":
+			self.closed = False
+		self.visit(n.name) # n.field is not a variable
+
+	def visit_ArrayRef(self, n):
+		self.closed = False
+		self.generic_visit(n)
+
+	def visit_InitList(self, n):
+		self.braces = True
+		self.generic_visit(n)
+
+	def visit_FuncCall(self, n):
+		e = self.expandable(n)
+		if e is None:
+			self.pure = False
+			self.closed = False
+			self.generic_visit(n)
+			return
+
+		self.closed = self.closed and e.closed
+		self.free |= e.free
+		for i, slot in enumerate(ext_pycparser.slots_of(n.args) if n.args else []):
+			self.under(slot, times=e.count[i], conditional=i in e.cond or e.count[i] == 0)
+
+def scalar(ty):
+	"""
+	True if the values of the type can be converted by a cast.
+	"""
+	while isinstance(ty, c_ast.TypeDecl) and isinstance(ty.type, c_ast.IdentifierType) \
+			and ty.type.names[-1] in rewrite.t.typedefs:
+		ty = rewrite.t.typedefs[ty.type.names[-1]].type
+	if isinstance(ty, c_ast.PtrDecl):
+		return True
+	return isinstance(ty, c_ast.TypeDecl) and isinstance(ty.type, (c_ast.IdentifierType, c_ast.Enum))
+
+def cast(ty, expr):
+	"""
+	(T) expr if the type is scalar. The conversion done by the call.
+	"""
+	if not scalar(ty):
+		return expr
+	ty = ext_pycparser.unconst(ext_pycparser.copy_ast(ty))
+	ext_pycparser.RewriteTypeDecl(None).visit(ty)
+	return c_ast.Cast(c_ast.Typename(None, [], ty), expr)
+
+def macroName(name):
+	"""
+	Not macro_f that is the statement macro of f (--dialect=gnu)
+	"""
+	return "macro_expr_%s" % name
+
+def returnExpr(func):
+	"""
+	e of { return e; } or None
+	"""
+	items = func.body.block_items or []
+	if len(items) == 1 and isinstance(items[0], c_ast.Return):
+		return items[0].expr
+	return None
+
+def params(func):
+	if ext_pycparser.FuncDef(func).voidArgs():
+		return []
+	return [p.name for p in func.decl.type.args.params]
+
+class Substitute(ext_pycparser.NodeVisitor):
+	"""
+	The body of the macro. The params are renamed to the macro parameters
+	converted to their types and the expression functions are expanded.
+	"""
+	def __init__(self, table, expressions):
+		self.table = table # name -> node
+		self.expressions = expressions
+
+	def visit_ID(self, n):
+		if n.name in self.table:
+			self.current_slot.replace(ext_pycparser.copy_ast(self.table[n.name]))
+
+	def visit_StructRef(self, n):
+		self.visit(n.name)
+
+	def visit_FuncCall(self, n):
+		name = rewrite.FuncCallName(n)
+		if name in self.expressions:
+			n.name.name = macroName(name)
+		if n.args:
+			self.visit(n.args)
+
+class Expression:
+	"""
+	A function only returning an expression without side effects.
+	It is macroized into the expression itself.
+
+	inline int sq(int x) { return x * x; }
+	->
+	#define macro_expr_sq(_moi1) ((int) (((int) (_moi1)) * ((int) (_moi1))))
+
+	The argument is evaluated as many times as the param appears, so a
+	call can take an argument with side effects only if the expression
+	is closed and the param is evaluated exactly once.
+	"""
+	def __init__(self, func, effects, expressions):
+		self.name = ext_pycparser.FuncDef(func).name()
+		self.params = params(func)
+		self.count = [effects.count[p] for p in self.params]
+		self.cond = set([i for i, p in enumerate(self.params) if p in effects.cond])
+		self.closed = effects.closed
+		self.free = effects.free
+
+		names = [rewrite.newname() for _ in self.params]
+		table = {}
+		for name, param in zip(names, func.decl.type.args.params if self.params else []):
+			table[param.name] = cast(param.type, c_ast.ID("(%s)" % name)) # (x) for any argument
+		body = c_ast.Return(ext_pycparser.copy_ast(returnExpr(func)))
+		Substitute(table, expressions).visit(body)
+		body = cast(func.decl.type.type, body.expr)
+		self.macro = ext_pycparser.Any("#define %s(%s) (%s)\n" % (macroName(self.name), ', '.join(names), ext_pycparser.CGenerator().visit(body)))
+
+def expression_of(func, expressions):
+	"""
+	FuncDef -> Expression or None
+	"""
+	if ext_pycparser.FuncDef(func).returnVoid() or func.param_decls:
+		return None
+	expr = returnExpr(func)
+	if expr is None:
+		return None
+	names = params(func)
+
+	def expandable(call):
+		name = rewrite.FuncCallName(call)
+		if name in names: # A function pointer
+			return None
+		e = expressions.get(name)
+		if e is None or len(call.args.exprs if call.args else []) != len(e.params):
+			return None
+		if e.free & set(names): # Refers to the globals hidden by the params
+			return None
+		return e
+
+	effects = Effects(names, expandable)
+	effects.visit(c_ast.Return(expr))
+	effects.walk(func.decl.type) # The typedefs in the casts
+	if not effects.pure:
+		return None
+	return Expression(func, effects, expressions)
+
+class RewriteCaller(ext_pycparser.NodeVisitor, compound.SymbolTableMixin):
+	"""
+	f(x) -> macro_expr_f(x)
+
+	A call stays as it is (and can be macroized as a statement) if an
+	argument with side effects would be evaluated other than once or in
+	another order against the reads of the expression, or a name in the
+	expression is hidden by a local variable.
+	"""
+	def __init__(self, func, expressions):
+		compound.SymbolTableMixin.__init__(self, func, set(expressions))
+		self.expressions = expressions
+
+	def visit_Compound(self, n):
+		self.switch()
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
+		self.revert()
+
+	def visit_Decl(self, n):
+		self.register(n)
+		self.generic_visit(n)
+
+	def expandable(self, call):
+		name = rewrite.FuncCallName(call)
+		if not self.canMacroize(name):
+			return None
+		e = self.expressions[name]
+		args = call.args.exprs if call.args else []
+		if len(args) != len(e.params):
+			return None
+		if e.free & self.currentSymbols():
+			return None
+		for i, arg in enumerate(args):
+			effects = Effects([], self.expandable)
+			effects.visit(c_ast.ExprList([arg]))
+			if effects.braces:
+				return None
+			if not effects.pure and not (e.closed and e.count[i] == 1 and i not in e.cond):
+				return None
+		return e
+
+	def visit_FuncCall(self, n):
+		if self.expandable(n):
+			n.name.name = macroName(rewrite.FuncCallName(n))
+		self.generic_visit(n)
+
+class Main:
+	"""
+	AST -> AST
+
+	Finds the expression functions out of the candidates and rewrites
+	their calls into the expression macros (see Expression). The macros
+	are defined by rewrite_void before the preprocessing expands them.
+	"""
+	def __init__(self, ast, candidates):
+		self.ast = ast
+		self.candidates = candidates
+
+	def findExpressions(self):
+		# The expressions calling the others are found after them.
+		expressions = rewrite.t.expressions
+		found = True
+		while found:
+			found = False
+			for name in sorted(self.candidates - set(expressions)):
+				_, func = rewrite.t.all_funcs[name]
+				e = expression_of(func, expressions)
+				if e is not None:
+					expressions[name] = e
+					found = True
+
+	def run(self):
+		self.findExpressions()
+		if rewrite.t.expressions:
+			for _, func in sorted(rewrite.t.all_funcs.values()):
+				RewriteCaller(func, rewrite.t.expressions).visit(func)
+			recorder.t.file_record("rewrite_expressions", self.ast)
+		return self
+
+	def returnAST(self):
+		return self.ast
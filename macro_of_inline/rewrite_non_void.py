@@ -1,4 +1,4 @@
-from pycparser import c_ast, c_generator
+from pycparser import c_ast
 
 import cfg
 import compound
@@ -15,7 +15,7 @@ def mkDecl(func, newname):
 	"""
 	int f(...) {}, name -> int name;
 	"""
-	decl = copy.deepcopy(func.decl.type.type)
+	decl = ext_pycparser.unconst(ext_pycparser.copy_ast(func.decl.type.type)) # const T name; can't be assigned
 	ext_pycparser.RewriteTypeDecl(newname).visit(decl)
 	return c_ast.Decl(newname, [], [], [], decl, None, None)
 
@@ -45,22 +45,20 @@ class RewriteCaller:
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
 
 		def visit_Compound(self, n):
-			if not n.block_items:
-				return
-
 			self.switch()
 
-			insert_list = []
+			if not n.block_items:
+				return
 
 			def onFuncCall(call):
 				if not self.canMacroize(rewrite.FuncCallName(call)):
 					return
 
-				randvar = rewrite.newrandstr()
+				randvar = rewrite.newname()
 				n.block_items[i] = c_ast.Assignment("=", c_ast.ID(randvar), call)
 
 				_, func = rewrite.t.all_funcs[rewrite.FuncCallName(call)]
-				insert_list.append((0, mkDecl(func, randvar)))
+				self.insertFirst(ext_pycparser.Slot(n, "block_items", i), mkDecl(func, randvar))
 
 			for i, item in enumerate(n.block_items):
 				if isinstance(item, c_ast.Decl):
@@ -80,19 +78,17 @@ class RewriteCaller:
 
 					name = rewrite.FuncCallName(item.expr)
 
-					randvar = rewrite.newrandstr()
-					insert_list.append((i, c_ast.Assignment("=", c_ast.ID(randvar), item.expr)))
+					randvar = rewrite.newname()
+					slot = ext_pycparser.Slot(n, "block_items", i)
+					self.insertBefore(slot, c_ast.Assignment("=", c_ast.ID(randvar), item.expr))
 					item.expr = c_ast.ID(randvar)
 
 					_, func = rewrite.t.all_funcs[name]
-					insert_list.append((0, mkDecl(func, randvar)))
-
-			compound.NodeVisitor.generic_visit(self, n)
+					self.insertFirst(slot, mkDecl(func, randvar))
 
-			insert_list.sort(key=lambda x: -x[0])
-			for i, m in insert_list:
-				n.block_items.insert(i, m)
+			self.generic_visit(n)
 
+		def leave_Compound(self, n):
 			self.revert()
 
 	class PopNested(compound.NodeVisitor, compound.SymbolTableMixin):
@@ -102,24 +98,23 @@ class RewriteCaller:
 		def __init__(self, func, macroizables):
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
 			self.result = False # found
-			self.insert_list = [] # [(i, AST)]
-			self.nestedCall = []
+			self.stmt = None # Slot of the statement having the call in
 
 		def visit_Compound(self, n):
+			self.switch()
+
 			if self.result:
 				return
 
 			if not n.block_items:
 				return
 
-			self.switch()
-
 			for i, item in enumerate(n.block_items):
 				# We ignore Decls because inserting assignment (retval = g())
 				# before some variable declartion is rejected by compiler as
 				# mixed declaration (ISO C90).
-				# We can deal with it by popping out T retval = g() directly
-				# but it makes implementation so hard.
+				# The declarations having such calls are already split into
+				# T x; ... x = f(g()); by hoist.Hoist.
 				if isinstance(item, c_ast.Decl):
 					self.register(item)
 
@@ -130,34 +125,34 @@ class RewriteCaller:
 				if not isinstance(call, c_ast.FuncCall):
 					continue
 
-				self.nestedCall = [i]
-				compound.NodeVisitor.generic_visit(self, call)
-				self.nestedCall = []
+				self.stmt = ext_pycparser.Slot(n, "block_items", i)
+				for slot in ext_pycparser.slots_of(call):
+					self.walk(slot.get(), slot)
+				self.stmt = None
 
-			for i, m in sorted(self.insert_list, key=lambda x: -x[0]):
-				n.block_items.insert(i, m)
+			self.generic_visit(n)
 
-			compound.NodeVisitor.generic_visit(self, n)
+		def leave_Compound(self, n):
 			self.revert()
 
 		def visit_FuncCall(self, n):
-			if not self.nestedCall:
+			if not self.stmt:
 				return
 
 			name = rewrite.FuncCallName(n)
 			if not self.canMacroize(name):
-				compound.NodeVisitor.generic_visit(self, n)
+				self.generic_visit(n)
 				return
 
-			randvar = rewrite.newrandstr()
+			randvar = rewrite.newname()
 
-			ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, c_ast.ID(randvar))
+			self.current_slot.replace(c_ast.ID(randvar))
 			_, func = rewrite.t.all_funcs[name]
 
-			# Order of these two lines is important.
-			# nestedCall[0] can be 0. function call must be placed after declaring retval.
-			self.insert_list.append((self.nestedCall[0], c_ast.Assignment("=", c_ast.ID(randvar), n)))
-			self.insert_list.append((0, mkDecl(func, randvar)))
+			# The declaration goes first in the compound
+			# so the call placed before the statement is after declaring retval.
+			self.insertBefore(self.stmt, c_ast.Assignment("=", c_ast.ID(randvar), n))
+			self.insertFirst(self.stmt, mkDecl(func, randvar))
 
 			self.result = True
 
@@ -169,15 +164,18 @@ class RewriteCaller:
 			compound.SymbolTableMixin.__init__(self, func, macroizables)
 
 		def visit_Compound(self, n):
+			self.switch()
+
 			if not n.block_items:
 				return
 
-			self.switch()
 			for i, item in enumerate(n.block_items):
 				if isinstance(item, c_ast.Decl):
 					self.register(item)
 				if not isinstance(item, c_ast.Assignment):
 					continue
+				if item.op != "=": # r += f(...) can't be f(&r, ...)
+					continue
 				call = item.rvalue
 				if not isinstance(call, c_ast.FuncCall):
 					continue
@@ -191,7 +189,9 @@ class RewriteCaller:
 				call.args.exprs.insert(0, c_ast.UnaryOp("&", item.lvalue))
 				n.block_items[i] = call
 
-			compound.NodeVisitor.generic_visit(self, n)
+			self.generic_visit(n)
+
+		def leave_Compound(self, n):
 			self.revert()
 
 	def run(self):
@@ -222,19 +222,25 @@ class Main:
 	AST -> AST
 	"""
 	def __init__(self, ast):
-		rewrite.t.setupAST(ast)
+		rewrite.t.refresh(ast)
 		self.ast = ast
 
 	def rewriteCallers(self, macroizables):
-		for i, func in rewrite.t.all_funcs.values():
+		for i, func in sorted(rewrite.t.all_funcs.values()):
 			self.ast.ext[i] = RewriteCaller(func, macroizables).run().returnAST()
-		recorder.t.file_record("rewrite_all_callers", c_generator.CGenerator().visit(self.ast))
+		recorder.t.file_record("rewrite_all_callers", self.ast)
 
 	def rewriteDefs(self, macroizables):
 		void_funcs = []
 		for name in macroizables:
 			i, func = rewrite.t.all_funcs[name]
-			void_funcs.append((i, rewrite_non_void_fun.Main(copy.deepcopy(func)).run().returnAST()))
+			vfunc = rewrite_non_void_fun.Main(ext_pycparser.copy_ast(func)).run().returnAST()
+			void_funcs.append((i, vfunc))
+			rewrite.t.macroizables.add(vfunc.decl.name)
+			if rewrite.t.calls is not None: # Called as many times as the original
+				rewrite.t.calls[vfunc.decl.name] = rewrite.t.calls.get(name, 0)
+			if name in rewrite.t.copies: # Chosen with the original
+				rewrite.t.copies[vfunc.decl.name] = rewrite.t.copies[name]
 
 		void_funcs.sort(key=lambda x: -x[0]) # reverse order
 		for i, vfunc in void_funcs:
@@ -255,7 +261,7 @@ class Main:
 		# 		continue
 		# 	decl = copy.deepcopy(vfunc.decl)
 		# 	self.ast.ext.insert(declLocs[name], decl)
-		recorder.t.file_record("rewrite_func_defines", c_generator.CGenerator().visit(self.ast))
+		recorder.t.file_record("rewrite_func_defines", self.ast)
 
 	def run(self):
 		macroizables = set()
@@ -339,6 +345,20 @@ int foo(int x, ...);
 
 int bar() {}
 
+int vla(void)
+{
+	int n = h1(4);
+	int arr[n];
+	return (int) sizeof(arr);
+}
+
+int cst(void)
+{
+	const int c = h1(1);
+	int d = c;
+	return d;
+}
+
 inline int ffff(void)
 {
   if (0)
@@ -376,7 +396,9 @@ int main()
 """
 
 if __name__ == "__main__":
+	rewrite.MACROIZE_EXPRESSION = False # The functions in the test are all expressions
 	ast = ext_pycparser.ast_of(test_file)
+	rewrite.t.setupAST(ast)
 	# ast.show()
 	ast = Main(ast).run().returnAST()
 	# ast.show()
@@ -1,6 +1,5 @@
 from pycparser import c_ast
 
-import copy
 import ext_pycparser
 import recorder
 import rewrite
@@ -30,7 +29,7 @@ class Main(ext_pycparser.FuncDef):
 		self.func.decl.name = newname
 		ext_pycparser.RewriteTypeDecl(newname).visit(funtype.type)
 
-		rettype = copy.deepcopy(funtype.type)
+		rettype = ext_pycparser.unconst(ext_pycparser.copy_ast(funtype.type)) # *retval = x for const T f()
 		ext_pycparser.RewriteTypeDecl("retval").visit(rettype)
 		newarg = c_ast.Decl("retval", [], [], [], c_ast.PtrDecl([], rettype), None, None)
 		params = []
@@ -52,20 +51,13 @@ class Main(ext_pycparser.FuncDef):
 			ass = c_ast.Assignment("=",
 						c_ast.UnaryOp("*", c_ast.ID("retval")), # lvalue
 						n.expr) # rvalue
-			ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, ass)
-
-			compound = self.current_parent
-
 			# We expect that the parent is compound (because we will have at least two lines in there).
 			# However, some hacky code omits curly braces (Linux kernel even oblige this).
-			if not isinstance(self.current_parent, c_ast.Compound):
-				compound = c_ast.Compound([ass])
-				ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, compound)
-
-			# Since we are visiting in depth-first and
-			# pycparser's children() method first create nodelist
-			# it is safe to add some node as sibling (but it won't be visited)
-			compound.block_items.append(c_ast.Return(None))
+			if isinstance(self.current_slot.owner, c_ast.Compound):
+				self.current_slot.replace(ass)
+				self.insertAfter(self.current_slot, c_ast.Return(None))
+			else:
+				self.current_slot.replace(c_ast.Compound([ass, c_ast.Return(None)]))
 
 	def rewriteReturn(self):
 		self.phase_no += 1
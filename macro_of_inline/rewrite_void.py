@@ -2,21 +2,24 @@ from pycparser import c_parser, c_ast
 
 import os
 
+import budget
 import cfg
 import compound
 import copy
 import cppwrap
+import devirtualize
 import ext_pycparser
 import pycparser
 import recorder
 import rewrite
+import rewrite_expr
 import rewrite_void_fun
 import sys
 import utils
 
 NORMALIZE_LABEL = True
 
-class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
+class RewriteCaller(ext_pycparser.NodeVisitor, compound.SymbolTableMixin):
 	"""
 	Add random namespace macro calls.
 
@@ -42,31 +45,67 @@ class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
 	} while (0)
 	f(rand_label_1);
 	f(rand_label_2); // won't conflict
+
+	All the calls are visited. Those in the expressions are only
+	macroizable with --dialect=gnu (rewrite.Context.blacklist).
+
+	direct: name -> [bool] for each argument, True if the arguments
+	at all the calls can be used in the macro directly (see plain()).
 	"""
-	def __init__(self, func, macroizables):
+	def __init__(self, func, macroizables, budget, direct):
 		compound.SymbolTableMixin.__init__(self, func, macroizables)
-		name = ext_pycparser.FuncDef(func).name()
-		self.called_in_macro = True if name in macroizables else False
+		self.name = ext_pycparser.FuncDef(func).name()
+		self.called_in_macro = True if self.name in macroizables else False
+		self.budget = budget
+		self.direct = direct
+		self.addressed = ext_pycparser.Result(AddressTaken()).visit(func.body)
+		self.externs = set()
 
 	def visit_Compound(self, n):
 		self.switch()
-		ext_pycparser.NodeVisitor.generic_visit(self, n)
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
 		self.revert()
 
 	def visit_Decl(self, n):
 		self.register(n)
+		if "extern" in n.storage:
+			self.externs.add(n.name)
+		if n.init:
+			self.visit(n.init)
+
+	def plain(self, arg):
+		"""
+		A literal or a local variable whose address is never taken.
+		Nothing but the caller modifies it while the macro runs.
+		"""
+		if isinstance(arg, c_ast.Constant):
+			return True
+		if isinstance(arg, c_ast.ID):
+			return arg.name in self.currentSymbols() and not arg.name in self.addressed | self.externs
+		return False
 
 	def visit_FuncCall(self, n):
 		name = rewrite.FuncCallName(n)
+		self.generic_visit(n) # The calls in the arguments
 
 		if not self.canMacroize(name):
 			return
 
+		if not self.budget.admit(self.name, name): # Stays a real call
+			return
+
+		plain = [self.plain(arg) for arg in (n.args.exprs if n.args else [])]
+		if name in self.direct:
+			plain = [x and y for x, y in zip(self.direct[name], plain)]
+		self.direct[name] = plain
+
 		# Assignment to n.name.name always work because we only consider
 		# basic function call f(...).
 		n.name.name = "macro_%s" % name # macro_f(...)
 
-		namespace = rewrite.newrandstr()
+		namespace = rewrite.newname()
 		if self.called_in_macro:
 			namespace = "namespace ## %s" % namespace
 
@@ -74,18 +113,54 @@ class RewriteCaller(compound.NodeVisitor, compound.SymbolTableMixin):
 			n.args = c_ast.ExprList([])
 		n.args.exprs.insert(0, c_ast.ID(namespace)) # macro_f(namespace, ...)
 
+class AddressTaken(ext_pycparser.NodeVisitor):
+	"""
+	The names of the variables whose addresses are taken (&x, &x.f, &x[i])
+	"""
+	def __init__(self):
+		self.result = set()
+
+	def visit_UnaryOp(self, n):
+		if n.op == "&":
+			name = devirtualize.root(n.expr)
+			if name:
+				self.result.add(name)
+		self.generic_visit(n)
+
+def sharable(ty, structs):
+	"""
+	The param of the type can be the argument itself while only read.
+	The arrays in a struct would decay into the pointers (x.buf) to the
+	argument that may be modified through them.
+	"""
+	while isinstance(ty, c_ast.TypeDecl) and isinstance(ty.type, c_ast.IdentifierType) \
+			and ty.type.names[-1] in rewrite.t.typedefs:
+		ty = rewrite.t.typedefs[ty.type.names[-1]].type
+	if rewrite_expr.scalar(ty):
+		return True
+	if not isinstance(ty, c_ast.TypeDecl) or not isinstance(ty.type, (c_ast.Struct, c_ast.Union)):
+		return False
+	decls = ty.type.decls
+	if decls is None:
+		definition = structs.get((ty.type.__class__, ty.type.name))
+		decls = definition.decls if definition else None
+	return decls is not None and all(sharable(field.type, structs) for field in decls)
+
 class Main:
 	"""
 	AST -> AST
 	"""
 	def __init__(self, ast):
-		rewrite.t.setupAST(ast)
+		rewrite.t.refresh(ast)
 		self.ast = ast
+		self.direct = {} # name -> [bool] (RewriteCaller)
 
 	def applyPreprocess(self):
 		fn = "/tmp/%s.c" % utils.randstr(16)
 		with open(fn, "w") as fp:
-			txt = ext_pycparser.CGenerator().visit(self.ast)
+			# Keep track of the origins of the nodes for the callers to tell the
+			# included code from the rest.
+			txt = ext_pycparser.CGenerator(linemarkers=True).visit(self.ast)
 			fp.write(ext_pycparser.CGenerator.cleanUp(txt))
 		try:
 			cpped_txt = utils.preprocess_file(fn, cpp_path='gcc', cpp_args=['-E'])
@@ -104,7 +179,7 @@ class Main:
 
 		def do_visit(self, n):
 			if n.name not in self.m:
-				self.m[n.name] = rewrite.newrandstr()
+				self.m[n.name] = rewrite.newname()
 			n.name = self.m[n.name]
 
 		def visit_Goto(self, n):
@@ -112,31 +187,68 @@ class Main:
 
 		def visit_Label(self, n):
 			self.do_visit(n)
-			ext_pycparser.NodeVisitor.generic_visit(self, n)
+			self.generic_visit(n)
 
 	def normalizeLabels(self):
-		self.NormalizeLabels().visit(self.ast)
+		visitor = self.NormalizeLabels()
+		for n in self.ast.ext:
+			# Labels are only in function bodies.
+			if isinstance(n, c_ast.FuncDef):
+				visitor.visit(n)
 
 	def rewriteCallers(self, macroizables):
-		for (_, func) in rewrite.t.all_funcs.values():
-			RewriteCaller(func, macroizables).visit(func)
-		recorder.t.file_record("rewrite_func_call", ext_pycparser.CGenerator().visit(self.ast))
+		# The callees first for the budget to know their expanded sizes.
+		b = budget.Budget(rewrite.t.all_funcs, macroizables)
+		self.order = b.order()
+		for name in self.order:
+			_, func = rewrite.t.all_funcs[name]
+			b.begin(name)
+			RewriteCaller(func, macroizables, b, self.direct).visit(func)
+			b.finish(name)
+		recorder.t.file_record("rewrite_func_call", self.ast)
 
 	def rewriteDefs(self, macroizables):
+		"""
+		The functions are macroized bottom-up over the call graph (the order
+		of the callers rewritten) and the macros are defined in that order.
+
+		The callee macros are complete before the macros calling them, so
+		they are expanded into the bodies of the callers here, once
+		(rewrite_void_fun.Main.expandCalls). A caller macro gives each call
+		its own namespace under the namespace of the caller's call site
+		(namespace ## _moiN, see RewriteCaller), so the labels of the
+		expansion are still unique at every site. The calls in the
+		expressions (--dialect=gnu) stay macro calls for cpp.
+		"""
+		structs = devirtualize.Structs()
+		for n in devirtualize.Main(self.ast).nodes():
+			structs.visit(n)
+
 		runners = []
-		for name in macroizables:
+		for name in self.order:
+			if not name in macroizables:
+				continue
 			i, func = rewrite.t.all_funcs[name]
-			runner = rewrite_void_fun.Main(func)
+			direct = self.direct.get(name, [])
+			if direct:
+				params = func.decl.type.args.params
+				direct = [x and sharable(p.type, structs.result) for x, p in zip(direct, params)]
+			runner = rewrite_void_fun.Main(func, direct)
 			runners.append((i, runner))
 
 		for i, runner in runners:
 			runner.sanitizeNames()
-		recorder.t.file_record("sanitize_names", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("sanitize_names", self.ast)
 
-		for i, runner in reversed(runners):
-			runner.insertGotoLabel().show().rewriteReturnToGoto().show().appendNamespaceToLabels().show().macroize().show()
+		callees = {} # macro name -> ([param], body)
+		for i, runner in runners:
+			runner.insertGotoLabel().show().rewriteReturnToGoto().show().appendNamespaceToLabels().show()
+			runner.expandCalls(callees).show()
+			if runner.retval is None: # The value of ({ ... }) (--dialect=gnu) isn't of a statement
+				callees["macro_%s" % runner.name()] = runner.expansion()
+			runner.macroize().show()
 			self.ast.ext[i] = runner.returnAST()
-		recorder.t.file_record("macroize", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("macroize", self.ast)
 
 	class PurgeInlines(ext_pycparser.NodeVisitor):
 		"""
@@ -158,6 +270,14 @@ class Main:
 			if "inline" in n.funcspec:
 				n.funcspec.remove("inline")
 
+		def visit_Aside(self, n):
+			# Only the top-level declarations can be inline.
+			for m in n.nodes:
+				decl = m.decl if isinstance(m, c_ast.FuncDef) else m
+				if isinstance(decl, c_ast.Decl) and "inline" in decl.funcspec:
+					decl.funcspec.remove("inline")
+			n.text = {}
+
 	def prependPrototypes(self):
 		all_funcdefs = []
 		for i, n in enumerate(self.ast.ext):
@@ -165,17 +285,17 @@ class Main:
 				all_funcdefs.append((i, n))
 
 		for i, n in reversed(all_funcdefs):
-			decl = copy.deepcopy(n.decl)
+			decl = ext_pycparser.copy_ast(n.decl)
 			self.ast.ext.insert(i, decl)
 
 	def moveDecls(self):
 		"""
-		Move all Decls and Typedefs to the head of the file in order
+		Move all Decls and Typedefs (and the nodes aside) to the head of the file in order
 		"""
 		all_decls = []
 		for i, n in enumerate(self.ast.ext):
 			shouldMove = False
-			if isinstance(n, (c_ast.Typedef, c_ast.Decl)):
+			if isinstance(n, (c_ast.Typedef, c_ast.Decl, ext_pycparser.Aside)):
 				shouldMove = True
 			if shouldMove:
 				all_decls.append((i, n))
@@ -302,7 +422,7 @@ class Main:
 
 		for name in rewrite.t.macroizables:
 			_, func = rewrite.t.all_funcs[name]
-			if ext_pycparser.FuncDef(func).returnVoid():
+			if cfg.t.dialect == "gnu" or ext_pycparser.FuncDef(func).returnVoid():
 				macroizables.add(name)
 
 		# We keep the original FuncDefs and revive them after the
@@ -310,7 +430,7 @@ class Main:
 		orig_funcs = []
 		for name in macroizables:
 			i, func = rewrite.t.all_funcs[name]
-			orig_funcs.append((i, copy.deepcopy(func)))
+			orig_funcs.append((i, ext_pycparser.copy_ast(func)))
 		orig_funcs.sort(key=lambda x: -x[0]) # reversed order by lineno
 
 		self.rewriteCallers(macroizables)
@@ -320,8 +440,10 @@ class Main:
 		self.rewriteDefs(macroizables)
 
 		macro_funcs = []
-		for i, _ in orig_funcs:
-			macro_funcs.append((i, self.ast.ext[i])) # reversed order
+		for name in reversed(self.order):
+			if name in macroizables:
+				i, _ = rewrite.t.all_funcs[name]
+				macro_funcs.append((i, self.ast.ext[i])) # reversed order
 
 		for i, func in orig_funcs:
 			self.ast.ext[i] = func
@@ -329,30 +451,37 @@ class Main:
 		self.PurgeInlines().visit(self.ast)
 
 		self.prependPrototypes()
-		recorder.t.file_record("prepend_prototypes", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("prepend_prototypes", self.ast)
 
 		self.moveDecls()
-		recorder.t.file_record("move_decls", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("move_decls", self.ast)
 
 		for _, mfunc in macro_funcs:
 			self.ast.ext.insert(0, mfunc)
-		recorder.t.file_record("insert_macros", ext_pycparser.CGenerator().visit(self.ast))
+		for _, e in sorted(rewrite.t.expressions.items()):
+			self.ast.ext.insert(0, e.macro)
+		recorder.t.file_record("insert_macros", self.ast)
 		# print ext_pycparser.CGenerator().visit(self.ast)
 
+		if cfg.t.dialect == "gnu":
+			# Pycparser can't parse the statement expressions.
+			# The macros are expanded by the compiler.
+			return self
+
 		self.applyPreprocess() # Apply cpp is necessary for the later stages.
-		recorder.t.file_record("apply_preprocess", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("apply_preprocess", self.ast)
 
 		if NORMALIZE_LABEL:
-			# Normalize labels to fixed length. Some compilers won't allow labels too long.
+			# Normalize labels to short ones. Some compilers won't allow labels too long.
 			self.normalizeLabels()
-		recorder.t.file_record("normalize_labels", ext_pycparser.CGenerator().visit(self.ast))
+		recorder.t.file_record("normalize_labels", self.ast)
 
 		# FIXME I think now this makes no sence at all because of moveDecls()
 		# self.prependDecls()
-		# recorder.t.file_record("prepend_decls", ext_pycparser.CGenerator().visit(self.ast))
+		# recorder.t.file_record("prepend_decls", self.ast)
 
 		# self.prependFuncDecls()
-		# recorder.t.file_record("prepend_func_decls", ext_pycparser.CGenerator().visit(self.ast))
+		# recorder.t.file_record("prepend_func_decls", self.ast)
 
 		return self
 
@@ -429,6 +558,7 @@ int main()
 if __name__ == "__main__":
 	parser = c_parser.CParser()
 	ast = parser.parse(testcase)
+	rewrite.t.setupAST(ast)
 	# ast.show()
 
 	output = Main(ast).run().returnAST()
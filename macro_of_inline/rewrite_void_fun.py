@@ -1,19 +1,22 @@
 from pycparser import c_parser, c_ast
 
 import collections
-import copy
 import enum
+import re
 
 import cfg
+import devirtualize
 import ext_pycparser
 import recorder
 import rewrite
+import rewrite_expr
+import rewrite_non_void
 import utils
 
 Symbol = collections.namedtuple('Symbol', 'alias, overwritable')
 
-# False -> ($oldname -> $randstr)
-# True  -> ($oldname -> ($oldname_$randstr))
+# False -> ($oldname -> $newname)
+# True  -> ($oldname -> ($oldname_$newname))
 VERBOSE = True
 
 class NameTable:
@@ -22,7 +25,7 @@ class NameTable:
 		self.prev_table = None
 
 	def register(self, name):
-		alias = rewrite.newrandstr()
+		alias = rewrite.newname()
 		if VERBOSE:
 			alias = "%s_%s" % (name, alias)
 		self.table[name] = Symbol(alias, overwritable=False)
@@ -62,7 +65,9 @@ class RenameVars(ext_pycparser.NodeVisitor):
 
 	def visit_Compound(self, node):
 		self.switchTable()
-		ext_pycparser.NodeVisitor.generic_visit(self, node)
+		self.generic_visit(node)
+
+	def leave_Compound(self, node):
 		self.revertTable()
 
 	def visit_Decl(self, node):
@@ -74,7 +79,7 @@ class RenameVars(ext_pycparser.NodeVisitor):
 		utils.P("Decl: %s -> %s" % (node.name, alias))
 		node.name = alias
 		ext_pycparser.RewriteTypeDecl(alias).visit(node.type)
-		ext_pycparser.NodeVisitor.generic_visit(self, node)
+		self.generic_visit(node)
 
 	def visit_StructRef(self, node):
 		"""
@@ -122,6 +127,7 @@ PHASES = [
 	"insert_goto_label",
 	"rewrite_return_to_goto",
 	"append_namespace_to_labels",
+	"expand_calls",
 	"memoize"]
 
 class Main(ext_pycparser.FuncDef):
@@ -154,13 +160,21 @@ class Main(ext_pycparser.FuncDef):
 
 			return True
 
-	def __init__(self, func):
+	def __init__(self, func, direct=None):
 		self.phase_no = 0
 		self.func = func
 
+		# The arguments that can be used directly at all the calls (rewrite_void.RewriteCaller)
+		self.direct = direct or []
+		# The params never modified nor pointed to don't need the copies of the arguments.
+		self.writes = ext_pycparser.Result(devirtualize.Writes()).visit(func.body)
+
 		# Like Maybe monad, we will keep the state if once failed.
 		self.ok = True
 
+		# The variable of the returned value (non-void function with --dialect=gnu)
+		self.retval = None
+
 		if utils.DEBUG:
 			self.func.show()
 
@@ -208,6 +222,12 @@ class Main(ext_pycparser.FuncDef):
 				self.renameDecl(arg.node, alias)
 		return self
 
+	def readOnly(self, i):
+		"""
+		The argument can be used in place of the param (i-th)
+		"""
+		return i < len(self.direct) and self.direct[i] and not self.args[i].node.name in self.writes
+
 	def insertDeclLines(self):
 		"""
 		Insert decl lines (see. shouldInsertDecl)
@@ -221,6 +241,15 @@ class Main(ext_pycparser.FuncDef):
 		  int rand3 = rand1;
 		  int rand4 = rand2;
 		}
+
+		The param only read and given the literals or the local variables
+		at all the calls is replaced by the argument converted to its type.
+
+		f(int rand1, char rand2)
+		{
+		  ... ((int) (rand1)) ...
+		  char rand4 = rand2;
+		}
 		"""
 		self.phase_no += 1
 		if not self.ok: return self
@@ -229,23 +258,29 @@ class Main(ext_pycparser.FuncDef):
 		if not block_items:
 			return self
 
-		for arg in reversed(self.args):
+		table = {}
+		for i, arg in reversed(list(enumerate(self.args))):
 			if arg.shouldInsertDecl():
-				newname = rewrite.newrandstr()
+				newname = rewrite.newname()
 
 				# Insert decl line
 				oldname = arg.node.name
 				if VERBOSE:
 					newname = "%s_%s" % (oldname, newname)
 
-				decl = copy.deepcopy(arg.node)
 				alias = self.init_table.alias(oldname)
-				self.renameDecl(decl, alias)
-				decl.init = c_ast.ID(newname)
-				block_items.insert(0, decl)
+				if self.readOnly(i):
+					table[alias] = rewrite_expr.cast(arg.node.type, c_ast.ID("(%s)" % newname))
+				else:
+					decl = ext_pycparser.copy_ast(arg.node)
+					self.renameDecl(decl, alias)
+					decl.init = c_ast.ID(newname)
+					block_items.insert(0, decl)
 
 				# Rename the arg
 				self.renameDecl(arg.node, newname)
+		if table:
+			rewrite_expr.Substitute(table, {}).visit(self.func.body)
 		return self
 
 	def sanitizeNames(self):
@@ -289,15 +324,27 @@ class Main(ext_pycparser.FuncDef):
 		"""
 		Visit a compound and rewrite "return" to "goto GOTO_LABEL".
 		We assume at most only one "return" exists in a compound.
+
+		return x; -> { retval = x; goto GOTO_LABEL; } (with retval)
 		"""
+		def __init__(self, retval):
+			self.retval = retval
+
 		def visit_Return(self, n):
-			ext_pycparser.NodeVisitor.rewrite(self.current_parent, self.current_name, c_ast.Goto(GOTO_LABEL))
+			goto = c_ast.Goto(GOTO_LABEL)
+			if self.retval is None or n.expr is None:
+				self.current_slot.replace(goto)
+			else:
+				assign = c_ast.Assignment("=", c_ast.ID(self.retval), n.expr)
+				self.current_slot.replace(c_ast.Compound([assign, goto]))
 
 	def rewriteReturnToGoto(self):
 		self.phase_no += 1
 		if not self.ok: return self
 
-		self.RewriteReturnToGoto().visit(self.func)
+		if not self.returnVoid():
+			self.retval = rewrite.newname()
+		self.RewriteReturnToGoto(self.retval).visit(self.func)
 		return self
 
 	class AppendNamespaceToLables(ext_pycparser.NodeVisitor):
@@ -306,7 +353,7 @@ class Main(ext_pycparser.FuncDef):
 
 		def visit_Label(self, n):
 			n.name = "namespace ## %s" % n.name
-			ext_pycparser.NodeVisitor.generic_visit(self, n) # Label has its own statements as its decendant.
+			self.generic_visit(n) # Label has its own statements as its decendant.
 
 	def appendNamespaceToLabels(self):
 		self.phase_no += 1
@@ -315,6 +362,73 @@ class Main(ext_pycparser.FuncDef):
 		self.AppendNamespaceToLables().visit(self.func)
 		return self
 
+	class ExpandCalls(ext_pycparser.NodeVisitor):
+		"""
+		Expand the calls to the callee macros in the statements as cpp does.
+
+		macro_g(namespace ## ns, a); -> do { ... namespace ## ns ## exit: ; } while (0);
+
+		The namespace of the expansion is the one of the call. It is the
+		namespace of this macro followed by a name unique in the body
+		(see rewrite_void.RewriteCaller) so the labels of the expansions
+		don't conflict.
+		"""
+		def __init__(self, callees):
+			self.callees = callees # macro name -> ([param], body)
+
+		def visit_FuncCall(self, n):
+			slot = self.current_slot
+			if not isinstance(slot.owner, (c_ast.Compound, c_ast.Case, c_ast.Default, c_ast.Label)) \
+					or slot.attr == "expr" or not isinstance(n.name, c_ast.ID) or not n.name.name in self.callees:
+				return
+			params, body = self.callees[n.name.name]
+			args = n.args.exprs
+			expansion = ext_pycparser.copy_ast(body)
+			Main.Instantiate(args[0].name, dict(zip(params, args[1:]))).visit(expansion)
+			slot.replace(c_ast.DoWhile(c_ast.Constant("int", "0"), expansion))
+
+	class Instantiate(ext_pycparser.NodeVisitor):
+		"""
+		The namespace and the params in the body replaced by the arguments
+		"""
+		def __init__(self, namespace, args):
+			self.namespace = namespace
+			self.args = args # param -> node
+
+		def rename(self, name):
+			return re.sub(r"\bnamespace\b", self.namespace, name)
+
+		def visit_ID(self, n):
+			name = n.name[1:-1] if n.name.startswith("(") else n.name # See insertDeclLines
+			if name in self.args:
+				self.current_slot.replace(ext_pycparser.copy_ast(self.args[name]))
+			else:
+				n.name = self.rename(n.name)
+
+		def visit_Goto(self, n):
+			n.name = self.rename(n.name)
+
+		def visit_Label(self, n):
+			n.name = self.rename(n.name)
+			self.generic_visit(n)
+
+	def expandCalls(self, callees):
+		"""
+		callees: macro name -> ([param], body) of the macros complete but not
+		yet macroized (see rewrite_void.Main.rewriteDefs)
+		"""
+		self.phase_no += 1
+		if not self.ok: return self
+
+		self.ExpandCalls(callees).visit(self.func.body)
+		return self
+
+	def expansion(self):
+		"""
+		([param], body) for expandCalls() of the callers
+		"""
+		return ([arg.node.name for arg in self.args], self.func.body)
+
 	def macroize(self):
 		self.phase_no += 1
 		if not self.ok: return self
@@ -326,7 +440,23 @@ class Main(ext_pycparser.FuncDef):
 		if not len(body_contents):
 			body_contents = [""]
 		body = '\n'.join(map(lambda x: "%s \\" % x, body_contents))
-		macro = r"""
+		if cfg.t.dialect == "gnu":
+			# Statement expression. The value is the last expression (retval).
+			decl = ""
+			value = ""
+			if self.retval:
+				decl = "%s; \\\n" % generator.visit(rewrite_non_void.mkDecl(self.func, self.retval))
+				value = "%s; \\\n" % self.retval
+			macro = r"""
+#define %s(%s) \
+({ \
+%sdo { \
+%s
+} while(0); \
+%s})
+""" % (fun_name, args, decl, body, value)
+		else:
+			macro = r"""
 #define %s(%s) \
 do { \
 %s
@@ -522,7 +652,7 @@ def test(testcase):
 	rewrite_fun = Main(ast.ext[0])
 	# print rewrite_fun.returnVoid()
 	# print rewrite_fun.voidArgs()
-	rewrite_fun.renameFuncBody().show().renameArgs().show().insertDeclLines().show().insertGotoLabel().show().rewriteReturnToGoto().show().appendNamespaceToLabels().show().macroize().show().returnAST().show()
+	rewrite_fun.renameFuncBody().show().renameArgs().show().insertDeclLines().show().insertGotoLabel().show().rewriteReturnToGoto().show().appendNamespaceToLabels().show().expandCalls({}).show().macroize().show().returnAST().show()
 
 if __name__ == "__main__":
 	# test(testcase)
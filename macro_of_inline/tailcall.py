@@ -0,0 +1,282 @@
+from pycparser import c_ast
+
+import compound
+import ext_pycparser
+import gnu
+import recorder
+import rewrite
+import rewrite_void_fun
+
+class TailCalls(ext_pycparser.NodeVisitor, compound.SymbolTableMixin):
+	"""
+	The calls of the function to itself.
+
+	calls: ids of the calls in tail position
+	  return f(...);
+	  return c ? x : f(...); (either branch)
+	  f(...); return; (void)
+	  f(...); at the end of the body (void)
+	slots: [Slot] of the return statements and the call statements having them
+	others: number of the other calls
+	"""
+	def __init__(self, func):
+		compound.SymbolTableMixin.__init__(self, func, set([func.decl.name]))
+		self.name = func.decl.name
+		self.void = ext_pycparser.FuncDef(func).returnVoid()
+		self.calls = set()
+		self.slots = []
+		self.others = 0
+		self.ends = set([id(func.body)]) # The statements the function ends with
+		self.statements = set() # The calls followed by the return
+		self.returns = {} # id of the expression returned -> Slot of the return
+
+	def end(self, n):
+		self.ends.add(id(n))
+		if isinstance(n, c_ast.If):
+			self.end(n.iftrue)
+			if n.iffalse:
+				self.end(n.iffalse)
+		if isinstance(n, c_ast.Label):
+			self.end(n.stmt)
+
+	def visit_Decl(self, n):
+		self.register(n)
+		self.generic_visit(n)
+
+	def visit_Compound(self, n):
+		self.switch()
+		items = n.block_items or []
+		if items and id(n) in self.ends:
+			self.end(items[-1])
+		for item, following in zip(items, items[1:]):
+			if isinstance(following, c_ast.Return) and following.expr is None:
+				self.statements.add(id(item))
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
+		self.revert()
+
+	def visit_Return(self, n):
+		if n.expr:
+			self.returns[id(n.expr)] = self.current_slot
+		self.generic_visit(n)
+
+	def visit_TernaryOp(self, n):
+		if id(n) in self.returns:
+			self.returns[id(n.iftrue)] = self.returns[id(n)]
+			self.returns[id(n.iffalse)] = self.returns[id(n)]
+		self.generic_visit(n)
+
+	def visit_FuncCall(self, n):
+		if rewrite.FuncCallName(n) == self.name and self.canMacroize(self.name):
+			if id(n) in self.returns:
+				self.calls.add(id(n))
+				if not self.returns[id(n)] in self.slots:
+					self.slots.append(self.returns[id(n)])
+			elif self.void and (id(n) in self.ends or id(n) in self.statements):
+				self.calls.add(id(n))
+				self.slots.append(self.current_slot)
+			else:
+				self.others += 1
+		self.generic_visit(n)
+
+class Escapes(ext_pycparser.NodeVisitor):
+	"""
+	The function may leave a pointer to its params or locals (&x or a
+	local array) to the next call. They are shared by the iterations of
+	the loop while every call had its own.
+	"""
+	def __init__(self, params):
+		self.locals = set(params)
+		self.addressed = set()
+		self.arrays = False
+
+	def visit_Decl(self, n):
+		if not "static" in n.storage and not "extern" in n.storage:
+			self.locals.add(n.name)
+			if isinstance(n.type, c_ast.ArrayDecl):
+				self.arrays = True
+		self.generic_visit(n)
+
+	def visit_UnaryOp(self, n):
+		if n.op == "&":
+			e = n.expr
+			while isinstance(e, c_ast.ArrayRef) or (isinstance(e, c_ast.StructRef) and e.type == "."):
+				e = e.name
+			if isinstance(e, c_ast.ID):
+				self.addressed.add(e.name)
+		self.generic_visit(n)
+
+class Main:
+	"""
+	AST -> AST
+
+	Rewrites the calls of a function to itself in tail position into
+	the reassignment of the params and the jump back to the top of the body.
+	The function is no more recursive and macroized as the others. The label
+	is put under the namespace of the macro as the other labels are.
+
+	static inline int gcd(int a, int b) { return b ? gcd(b, a % b) : a; }
+	->
+	static inline int gcd(int a, int b)
+	{
+	  _moi0:
+	  {
+	    if (b) {
+	      int _moi1 = b;
+	      int _moi2 = a % b;
+	      a = _moi1;
+	      b = _moi2;
+	      goto _moi0;
+	    } else {
+	      return a;
+	    }
+	  }
+	}
+
+	A function calling itself other than in tail position stays as it is
+	(see --unroll-recursion).
+	"""
+	def __init__(self, ast):
+		self.ast = ast
+
+	def convertible(self, func):
+		f = rewrite.FuncDef(func)
+		if f.hasVarArgs() or func.param_decls or gnu.t.hides(func) or not f.chosen():
+			return False
+		params = [] if f.voidArgs() else func.decl.type.args.params
+		escapes = Escapes([p.name for p in params])
+		escapes.visit(func.body)
+		return not (escapes.arrays or escapes.locals & escapes.addressed)
+
+	def assignments(self, func, call):
+		"""
+		The statements reassigning the params to the arguments. None if can't.
+		The arguments are evaluated before any param is changed.
+		"""
+		params = [] if ext_pycparser.FuncDef(func).voidArgs() else func.decl.type.args.params
+		args = call.args.exprs if call.args else []
+		if len(args) != len(params):
+			return None
+
+		changed = []
+		for param, arg in zip(params, args):
+			if isinstance(arg, c_ast.ID) and arg.name == param.name:
+				continue
+			if "const" in param.quals or not rewrite_void_fun.Main.Arg(param).shouldInsertDecl():
+				return None
+			changed.append((param, arg))
+
+		names = set([param.name for param, _ in changed])
+		refers = lambda arg: names & set(ext_pycparser.Result(ext_pycparser.AllNames()).visit(arg))
+		items = []
+		if len(changed) > 1 and any(refers(arg) for _, arg in changed):
+			temps = []
+			for param, arg in changed:
+				decl = ext_pycparser.copy_ast(param)
+				decl.name = rewrite.newname()
+				ext_pycparser.RewriteTypeDecl(decl.name).visit(decl.type)
+				decl.init = arg
+				items.append(decl)
+				temps.append((param, c_ast.ID(decl.name)))
+			changed = temps
+		for param, arg in changed:
+			items.append(c_ast.Assignment("=", c_ast.ID(param.name), arg))
+		return items
+
+	def jump(self, func, e, calls, label):
+		"""
+		The statement of the tail call or the return of e. None if can't.
+
+		return c ? x : f(y); -> if (c) { return x; } else { x = y; goto label; }
+		"""
+		if id(e) in calls:
+			items = self.assignments(func, e)
+			if items is None:
+				return None
+			return c_ast.Compound(items + [c_ast.Goto(label)])
+		if isinstance(e, c_ast.TernaryOp):
+			iftrue = self.jump(func, e.iftrue, calls, label)
+			iffalse = self.jump(func, e.iffalse, calls, label)
+			if iftrue is None or iffalse is None:
+				return None
+			return c_ast.If(e.cond, c_ast.Compound([iftrue]), c_ast.Compound([iffalse]))
+		return c_ast.Return(e)
+
+	def convert(self, func):
+		visitor = TailCalls(func)
+		visitor.visit(func.body)
+		if not visitor.calls or visitor.others:
+			return False
+
+		label = rewrite.newname()
+		rewrites = []
+		for slot in visitor.slots:
+			n = slot.get()
+			jump = self.jump(func, n.expr if isinstance(n, c_ast.Return) else n, visitor.calls, label)
+			if jump is None:
+				return False
+			rewrites.append((slot, jump))
+		for slot, jump in rewrites:
+			slot.replace(jump)
+		# The locals are initialized again in the block.
+		func.body = c_ast.Compound([c_ast.Label(label, func.body)])
+		return True
+
+	def run(self):
+		converted = False
+		for _, func in sorted(rewrite.t.all_funcs.values()):
+			if self.convertible(func) and self.convert(func):
+				converted = True
+		if converted:
+			recorder.t.file_record("tail_call_to_loop", self.ast)
+		return self
+
+	def returnAST(self):
+		return self.ast
+
+test_file = r"""
+static inline int gcd(int a, int b)
+{
+	if (b == 0)
+		return a;
+	return gcd(b, a % b);
+}
+
+static inline int fact(int n, int acc) { return n <= 1 ? acc : fact(n - 1, acc * n); }
+
+struct list { struct list *next; int value; };
+static inline void visit(struct list *l, int *sum)
+{
+	if (!l)
+		return;
+	int v = l->value;
+	*sum += v;
+	visit(l->next, sum);
+}
+
+static inline int last(struct list *l)
+{
+	if (l->next) {
+		int last = 0;
+		return last;
+	}
+	return last(l->next);
+}
+
+static inline int addr(int n)
+{
+	int *p = &n;
+	return n ? addr(*p - 1) : 0;
+}
+
+static inline int sum(struct list *l)
+{
+	return l ? l->value + sum(l->next) : 0;
+}
+"""
+
+if __name__ == "__main__":
+	ast = ext_pycparser.ast_of(test_file)
+	rewrite.t.setupAST(ast)
+	print ext_pycparser.CGenerator().visit(ast)
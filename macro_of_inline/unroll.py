@@ -0,0 +1,133 @@
+from pycparser import c_ast
+
+import cfg
+import compound
+import ext_pycparser
+import gnu
+import recorder
+import rewrite
+
+class RenameCalls(ext_pycparser.NodeVisitor, compound.SymbolTableMixin):
+	"""
+	f(...) -> g(...) unless f is hidden by a local name
+	"""
+	def __init__(self, func, old, new):
+		compound.SymbolTableMixin.__init__(self, func, set([old]))
+		self.old = old
+		self.new = new
+
+	def visit_Decl(self, n):
+		self.register(n)
+		self.generic_visit(n)
+
+	def visit_Compound(self, n):
+		self.switch()
+		self.generic_visit(n)
+
+	def leave_Compound(self, n):
+		self.revert()
+
+	def visit_FuncCall(self, n):
+		if rewrite.FuncCallName(n) == self.old and self.canMacroize(self.old):
+			n.name = c_ast.ID(self.new, n.name.coord)
+		self.generic_visit(n)
+
+class Main:
+	"""
+	AST -> AST
+
+	Unrolls the self-recursive functions by depth levels (--unroll-recursion).
+	A function is copied depth times and each copy calls the next one
+	instead of itself. The last copy calls the original that stays a
+	real function. The calls from the other functions go to the first copy.
+
+	static inline int gcd(int a, int b) { return b ? gcd(b, a % b) : a; }
+	->
+	static inline int gcd(int a, int b) { return b ? gcd(b, a % b) : a; }
+	static inline int gcd__moi1(int a, int b) { return b ? gcd__moi2(b, a % b) : a; }
+	static inline int gcd__moi2(int a, int b) { return b ? gcd(b, a % b) : a; }
+
+	The copies are not recursive and macroized as the other functions.
+	They are static not to conflict with the copies in the other files.
+	"""
+	def __init__(self, ast, depth):
+		self.ast = ast
+		self.depth = depth
+
+	def unrollable(self, func):
+		f = rewrite.FuncDef(func)
+		if f.name() in rewrite.t.unrolled:
+			return False
+		return f.isRecursive() and not f.hasVarArgs() and not gnu.t.hides(func) and f.chosen()
+
+	def copies(self, func):
+		name = func.decl.name
+		names = ["%s_%s" % (name, rewrite.newname()) for _ in range(self.depth)]
+		result = []
+		for i, new in enumerate(names):
+			f = ext_pycparser.copy_ast(func)
+			f.decl.name = new
+			ext_pycparser.RewriteTypeDecl(new).visit(f.decl.type.type)
+			f.decl.storage = ["static"]
+			RenameCalls(f, name, names[i + 1] if i + 1 < len(names) else name).visit(f.body)
+			result.append(f)
+		return result
+
+	def run(self):
+		funcs = [n for n in self.ast.ext if isinstance(n, c_ast.FuncDef) and self.unrollable(n)]
+		for func in funcs:
+			name = func.decl.name
+			copies = self.copies(func)
+			rewrite.t.unrolled[name] = [f.decl.name for f in copies]
+			for f in copies:
+				rewrite.t.copies[f.decl.name] = name
+
+			for n in self.ast.ext:
+				if isinstance(n, c_ast.FuncDef) and n is not func:
+					RenameCalls(n, name, copies[0].decl.name).visit(n.body)
+			i = self.ast.ext.index(func)
+			self.ast.ext[i+1:i+1] = copies
+		if funcs:
+			recorder.t.file_record("unroll_recursion", self.ast)
+		return self
+
+	def returnAST(self):
+		return self.ast
+
+test_file = r"""
+static inline int gcd(int a, int b) { return b ? gcd(b, a % b) : a; }
+
+struct node { struct node *left, *right; int value; };
+inline int sum(struct node *n)
+{
+	if (!n)
+		return 0;
+	return n->value + sum(n->left) + sum(n->right);
+}
+
+inline void count(int *c, struct node *n)
+{
+	if (n) {
+		int sum = 1;
+		*c += sum;
+		count(c, n->left);
+		count(c, n->right);
+	}
+}
+
+int main(void)
+{
+	int c = 0;
+	struct node leaf = { 0, 0, 3 };
+	struct node root = { &leaf, 0, 4 };
+	count(&c, &root);
+	int (*f)(int, int) = gcd;
+	return gcd(12, 18) + sum(&root) + c + f(4, 6);
+}
+"""
+
+if __name__ == "__main__":
+	ast = ext_pycparser.ast_of(test_file)
+	cfg.t.unroll_recursion = 2
+	rewrite.t.setupAST(ast)
+	print ext_pycparser.CGenerator().visit(ast)
@@ -1,8 +1,13 @@
 import cfg
+import hashlib
+import os
 import pycparser
 import random
+import re
+import shutil
 import string
 import subprocess
+import tempfile
 
 DEBUG = False
 
@@ -11,19 +16,41 @@ def P(s):
 		return
 	print(s)
 
-N = 16
 def randstr(n):
 	return ''.join(random.choice(string.letters) for i in xrange(n))
 
-def newrandstr(names, n):
-	while True:
-		alias = randstr(n)
-		if alias in names:
-			continue
-		else:
-			names.add(alias)
-			break
-	return alias
+class NameGen:
+	"""
+	Deterministic name generator (prefix + counter).
+
+	Unlike random names, identical inputs always get identical names
+	so the output is reproducible (and compiler caches hit).
+
+	Every generated name contains the prefix and the prefix is chosen
+	not to appear in any reserved name. Thus generated names never
+	conflict with the names in the TU, even after concatenated
+	(namespace ## label) or suffixed (x_$name).
+	"""
+	def __init__(self, prefix, seed=0):
+		self.prefix = prefix
+		self.counter = seed
+		self.issued = False
+
+	def reserve(self, names):
+		"""
+		Reserving is only effective before the first name is issued.
+		After that the names in the AST include the generated ones.
+		"""
+		if self.issued:
+			return
+		while any(self.prefix in name for name in names):
+			self.prefix += "_"
+
+	def new(self):
+		self.issued = True
+		name = "%s%d" % (self.prefix, self.counter)
+		self.counter += 1
+		return name
 
 def countMap(xs):
 	m = {}
@@ -53,6 +80,101 @@ def to_option(x):
 		i += 1
 	return ''.join(l)
 
+# Both #line N "file" (mcpp) and # N "file" flags (gcc)
+LINEMARKER = re.compile(r'^#\s*(?:line\s+)?\d+\s+"(.*)"')
+
+def included_files(txt):
+	"""
+	Text -> [filename]
+
+	Files in the line markers of preprocessed text in order of appearance.
+	Pseudo files like <command-line> are excluded.
+	"""
+	result = []
+	seen = set()
+	for line in txt.splitlines():
+		if not line.startswith("#"):
+			continue
+		m = LINEMARKER.match(line)
+		if not m:
+			continue
+		fn = m.group(1).replace('\\\\', '\\')
+		if fn.startswith("<") or fn in seen:
+			continue
+		seen.add(fn)
+		result.append(fn)
+	return result
+
+def tool_files():
+	"""
+	The source files of this program.
+	Any change of them can change the output.
+	"""
+	dn = os.path.dirname(os.path.abspath(__file__))
+	return sorted([os.path.join(dn, fn) for fn in os.listdir(dn) if fn.endswith(".py")])
+
+def make_escape(fn):
+	"""
+	File name -> its spelling in a Makefile (as gcc -M does)
+
+	The backslashes before a space or a tab are doubled and the space
+	or the tab is escaped. $ is written as $$ and # is escaped.
+	"""
+	def escape(m):
+		if m.group(2) == "$":
+			return m.group(1) + "$$"
+		if m.group(2) == "#":
+			return m.group(1) + "\\#"
+		return m.group(1) * 2 + "\\" + m.group(2)
+	return re.sub(r'(\\*)([ \t$#])', escape, fn)
+
+def depfile(target, deps, phony=False):
+	"""
+	Makefile-format dependency file (like gcc -MD)
+
+	The target is written as it is (see make_escape).
+	With phony, every dependency but the first (the input) gets
+	an empty rule (like gcc -MP) so make doesn't fail on the deleted ones.
+	"""
+	txt = "%s: %s\n" % (target, " \\\n  ".join(map(make_escape, deps)))
+	if phony:
+		txt += "".join(["\n%s:\n" % make_escape(fn) for fn in deps[1:]])
+	return txt
+
+def file_hash(filename):
+	with open(filename, "rb") as fp:
+		return hashlib.sha1(fp.read()).hexdigest()
+
+def write_file(filename, txt, only_if_changed=False):
+	"""
+	Write txt to the file atomically (write a temporary file in
+	the same directory and rename it). If only_if_changed is set
+	the file is left untouched (keeps its mtime) when the contents
+	are the same.
+
+	Return True iff the file is written.
+	"""
+	if only_if_changed and os.path.exists(filename):
+		if file_hash(filename) == hashlib.sha1(txt).hexdigest():
+			return False
+
+	dn = os.path.dirname(os.path.abspath(filename))
+	fd, tmp = tempfile.mkstemp(dir=dn, prefix=".macro-of-inline-")
+	try:
+		with os.fdopen(fd, "w") as fp:
+			fp.write(txt)
+		if os.path.exists(filename):
+			shutil.copymode(filename, tmp)
+		else: # mkstemp() creates the file with 0600
+			umask = os.umask(0)
+			os.umask(umask)
+			os.chmod(tmp, 0666 & ~umask)
+		os.rename(tmp, filename)
+	except:
+		os.remove(tmp)
+		raise
+	return True
+
 def preprocess_file(filename, cpp_path, cpp_args=''):
 	path_list = [cpp_path]
 	if isinstance(cpp_args, list):
@@ -76,10 +198,11 @@ def cpp(filename):
 	"""
 	File -> Text
 
-	__builtin_va_list is really built-in and we can't access the
-	definition in header file. We redefine this for parsing.
+	__GNUC__ is kept defined so the headers take the same paths as
+	compiled. The GNU extensions in the text are masked before parsing
+	(see gnu.Extensions).
 	"""
-	cpp_args = ['-E', '-U__GNUC__']
+	cpp_args = ['-E']
 	cpp_args.extend([r'%s' % to_option(option) for option in cfg.t.extra_options])
 	return preprocess_file(filename, cpp_path='gcc', cpp_args=cpp_args)
 
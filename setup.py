@@ -15,7 +15,7 @@ setup (
 		author_email = 'ruby.wktk@gmail.com',
 		url = 'https://github.com/akiradeveloper/macro-of-inline',
 		platforms = ['Cross Platform'],
-		scripts= ['bin/macro-of-inline'],
+		scripts= ['bin/macro-of-inline', 'bin/macro-of-inline-cc'],
 		packages = ['macro_of_inline'],
 		package_data = {'macro_of_inline' : ['fake_libc_include/*.h']},
 		include_package_data = True,